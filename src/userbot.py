@@ -1,17 +1,37 @@
 import asyncio
+import contextvars
+import ctypes
+import functools
 import gc
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
 import multiprocessing
 import os
 import re
+import socket
 import sqlite3
 import sys
-from concurrent.futures import ThreadPoolExecutor
-
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import NamedTuple, Optional
+
+import ctranslate2
+import numpy as np
 import redis
-from deepmultilingualpunctuation import PunctuationModel
 from faster_whisper import WhisperModel
+from faster_whisper.audio import decode_audio
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 from pyrogram import Client, filters, idle
 from pyrogram.errors import PeerIdInvalid, UserIdInvalid, UsernameInvalid
 from pyrogram.types import Message
@@ -40,8 +60,16 @@ API_ID = int(os.getenv("API_ID") or "0")
 API_HASH = os.getenv("API_HASH") or ""
 FRIEND_ID = int(os.getenv("FRIEND_USER_ID") or "0")
 MODEL_SIZE = os.getenv("WHISPER_MODEL") or "small"
-
-if API_ID == 0 or not API_HASH:
+# auto — язык определяется и запоминается по собеседнику; ru/en/... — всегда этот
+WHISPER_LANGUAGE = (os.getenv("WHISPER_LANGUAGE") or "auto").lower()
+REDIS_HOST = os.getenv("REDIS_HOST") or "redis"
+# `python src/userbot.py --worker` — воркер: без Telegram, только задания из Redis
+WORKER_MODE = "--worker" in sys.argv
+# Бот сам не распознаёт, а отдаёт голосовые воркерам через Redis Streams
+REMOTE_WORKERS = os.getenv("REMOTE_WORKERS", "false").lower() == "true"
+REMOTE = REMOTE_WORKERS and not WORKER_MODE
+
+if not WORKER_MODE and (API_ID == 0 or not API_HASH):
     raise ValueError(
         "❌ API_ID и API_HASH обязательны! Проверьте .env / docker-compose.yml"
     )
@@ -50,7 +78,7 @@ CAPTION_LIMIT = 1024
 MESSAGE_LIMIT = 4096
 
 # ==================== Redis ====================
-r = redis.Redis(host="redis", port=6379, db=0, decode_responses=True)
+r = redis.Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
 
 if not r.exists("enabled"):
     r.set("enabled", "1")
@@ -77,139 +105,2796 @@ SESSION_WORKDIR = "session" if RUNNING_IN_DOCKER else "."
 SESSION_FILE = os.path.join(os.path.abspath(SESSION_WORKDIR), SESSION_NAME + ".session")
 
 logger.info(f"Session: {SESSION_FILE}")
-if not os.path.exists(SESSION_FILE):
-    logger.critical(
-        f"❌ Session файл не найден: {SESSION_FILE}\n"
-        "   Создайте: docker-compose run --rm userbot python scripts/auth_docker.py"
+if not WORKER_MODE:
+    if not os.path.exists(SESSION_FILE):
+        logger.critical(
+            f"❌ Session файл не найден: {SESSION_FILE}\n"
+            "   Создайте: docker-compose run --rm userbot python scripts/auth_docker.py"
+        )
+        sys.exit(1)
+    try:
+        _c = sqlite3.connect(SESSION_FILE)
+        _c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        _c.close()
+        logger.info(f"Session валиден ({os.path.getsize(SESSION_FILE)} байт)")
+    except Exception as _e:
+        logger.critical(f"❌ Session повреждён: {_e}")
+        sys.exit(1)
+
+# ==================== Клиент ====================
+# Синхронный паттерн как в старом рабочем боте + workdir для Docker
+app = Client(
+    SESSION_NAME,
+    api_id=API_ID,
+    api_hash=API_HASH,
+    workdir=SESSION_WORKDIR,
+)
+
+# ==================== Модели ====================
+model = None
+punct_model = None
+CPU_CORES = multiprocessing.cpu_count()
+# Сколько голосовых транскрибируется одновременно. Ядра делятся между ними поровну,
+# иначе CPU_CORES задач × CPU_CORES потоков CTranslate2 дерутся за одни и те же ядра.
+TRANSCRIBE_SLOTS = max(1, int(os.getenv("TRANSCRIBE_SLOTS") or max(1, CPU_CORES // 4)))
+WHISPER_THREADS = max(1, CPU_CORES // TRANSCRIBE_SLOTS)
+executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_SLOTS)
+# Черновики PREVIEW_MODEL — в своём потоке: в executor они вставали бы за основной
+# прогон того же голосового и были бы готовы только после итогового текста
+preview_executor = ThreadPoolExecutor(max_workers=1)
+# Батч-режим: голосовые, пришедшие в пределах окна, идут одним проходом модели
+BATCH_SIZE = max(1, int(os.getenv("BATCH_SIZE") or "1"))
+BATCH_WINDOW = int(os.getenv("BATCH_WINDOW_MS") or "300") / 1000
+# Упаковка: короткие голосовые батча с известным языком склеиваются через паузы в
+# общие 30-секундные окна энкодера и разводятся обратно по таймингам слов
+PACK_VOICES = os.getenv("PACK_VOICES", "false").lower() == "true"
+PACK_GAP = 1.0
+# Как часто (сек) обновлять подпись/статус текстом, распознанным на данный момент. 0 — выкл
+STREAM_INTERVAL = float(os.getenv("STREAM_INTERVAL") or "5")
+# Кэш транскриптов в Redis по file_unique_id: лимит по объёму и время жизни
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB") or "64") * 1024 * 1024
+CACHE_TTL = int(os.getenv("CACHE_TTL_DAYS") or "30") * 86400
+# Доля несовпадающих бит отпечатка, при которой аудио считается тем же самым. 0 — выкл
+FINGERPRINT_BER = float(os.getenv("FINGERPRINT_BER") or "0.3")
+# Сколько отпечатков держать: от их числа зависит цена поиска по индексу
+FINGERPRINT_MAX = int(os.getenv("FINGERPRINT_MAX") or "10000")
+# Голосовые длиннее LONG_AUDIO_SECONDS (0 — выкл) режутся по паузам на куски,
+# которые распознаются параллельно во всех слотах
+LONG_AUDIO_SECONDS = int(os.getenv("LONG_AUDIO_SECONDS") or "600")
+# Инференс в TRANSCRIBE_SLOTS дочерних процессах: падение или OOM-kill
+# исполнителя не роняет клиент Telegram
+INFERENCE_PROCESSES = os.getenv("INFERENCE_PROCESSES", "false").lower() == "true"
+# Сколько недавно декодированного аудио держать в памяти для /timestamps
+RECENT_AUDIO_BYTES = int(os.getenv("RECENT_AUDIO_MB") or "128") * 1024 * 1024
+# Дисковый кэш ogg и PCM для /retranscribe: лимит по объёму. По умолчанию выкл —
+# иначе каждое голосовое пишется на диск; без кэша /retranscribe скачивает заново
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR") or "audio_cache"
+AUDIO_CACHE_BYTES = int(os.getenv("AUDIO_CACHE_MB") or "0") * 1024 * 1024
+# Конвейер: скачивание и декодирование следующих голосовых идут, пока распознаётся
+# текущее. Сверх мест распознавания планировщик пускает PIPELINE_PREFETCH голосовых
+PIPELINE_DOWNLOADS = max(1, int(os.getenv("PIPELINE_DOWNLOADS") or "4"))
+PIPELINE_DECODERS = max(1, int(os.getenv("PIPELINE_DECODERS") or "2"))
+PIPELINE_PREFETCH = int(os.getenv("PIPELINE_PREFETCH") or max(2, TRANSCRIBE_SLOTS))
+# Адаптивное качество: при очереди от DEGRADE_QUEUE голосовых (0 — выкл) или RTF
+# (время обработки / длительность аудио) выше DEGRADE_RTF декодирование упрощается
+DEGRADE_QUEUE = int(os.getenv("DEGRADE_QUEUE") or max(3, 2 * TRANSCRIBE_SLOTS))
+DEGRADE_RTF = float(os.getenv("DEGRADE_RTF") or "1.0")
+# Резидентная модель поменьше для последней ступени (пусто — не держать)
+DEGRADE_MODEL = os.getenv("DEGRADE_MODEL") or ""
+# Эскалация: неуверенные сегменты (avg_logprob ниже ESCALATE_LOGPROB, высокая
+# степень сжатия или вероятность тишины) переспрашиваются у резидентной модели
+# покрупнее. Пусто — выкл
+ESCALATE_MODEL = os.getenv("ESCALATE_MODEL") or ""
+ESCALATE_LOGPROB = float(os.getenv("ESCALATE_LOGPROB") or "-0.8")
+ESCALATE_COMPRESSION = 2.4
+ESCALATE_NO_SPEECH = 0.5
+ESCALATE_PAD = 0.5
+# Черновик своих голосовых: резидентная быстрая модель (например, tiny) сразу даёт
+# подпись, основная затем её заменяет. Пусто — выкл
+PREVIEW_MODEL = os.getenv("PREVIEW_MODEL") or ""
+# Модели — только с локального тома; докачка остальных AVAILABLE_MODELS в простое
+MODELS_DIR = os.getenv("HF_HOME") or os.path.expanduser("~/.cache/huggingface")
+MODELS_OFFLINE = os.getenv("MODELS_OFFLINE", "false").lower() == "true"
+MODELS_PREFETCH = os.getenv("MODELS_PREFETCH", "true").lower() == "true"
+# Вероятные следующие модели для /model: auto — недавние и соседние по размеру
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS") or "auto"
+# Сколько их весов держать прогретыми в page cache (0 — не прогревать)
+PRELOAD_CACHE_MB = int(os.getenv("PRELOAD_CACHE_MB") or "4096")
+# Держать первую из них полностью собранной, если хватает свободной памяти
+STANDBY_MODEL = os.getenv("STANDBY_MODEL", "false").lower() == "true"
+# Выгружать модели после стольких минут без голосовых (0 — держать всегда)
+MODEL_IDLE_MINUTES = float(os.getenv("MODEL_IDLE_MINUTES") or "0")
+# Потолок памяти под модели; 0 — MEMORY_BUDGET_SHARE от лимита cgroup контейнера
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB") or "0")
+MEMORY_BUDGET_SHARE = float(os.getenv("MEMORY_BUDGET_SHARE") or "0.85")
+# Голосовые скачиваются и декодируются в памяти; false — через temp/ (отладка)
+AUDIO_IN_MEMORY = os.getenv("AUDIO_IN_MEMORY", "true").lower() == "true"
+AVAILABLE_MODELS = ["tiny", "base", "small", "medium", "large-v2", "large-v3"]
+
+
+def get_tracked_users():
+    try:
+        users_json = r.get("tracked_users")
+        return json.loads(users_json) if users_json else []
+    except Exception:
+        return []
+
+
+def add_tracked_user(user_id: int):
+    users = get_tracked_users()
+    if user_id not in users:
+        users.append(user_id)
+        r.set("tracked_users", json.dumps(users))
+        return True
+    return False
+
+
+def remove_tracked_user(user_id: int):
+    users = get_tracked_users()
+    if user_id in users:
+        users.remove(user_id)
+        r.set("tracked_users", json.dumps(users))
+        return True
+    return False
+
+
+# ==================== Артефакты моделей ====================
+# Модели не резолвятся через Hugging Face Hub на каждом старте. При первой загрузке
+# ревизия (commit) и sha256 файлов записываются в manifest.json на томе; дальше
+# модель берётся строго локально с закреплённой ревизии, файлы сверяются с
+# манифестом (полный хеш — только если файл изменился с прошлой проверки). Нет
+# файлов или хеш не сошёлся — перекачка той же ревизии, при MODELS_OFFLINE — ошибка.
+PUNCT_REPO = "kredor/punctuate-all"
+WHISPER_FILES = [
+    "config.json",
+    "preprocessor_config.json",
+    "model.bin",
+    "tokenizer.json",
+    "vocabulary.*",
+]
+# Веса для TF/Flax/ONNX модели пунктуации не нужны
+PUNCT_IGNORE = ["*.h5", "*.msgpack", "*.onnx", "*.ot", "tf_*", "flax_*", "rust_*"]
+
+
+def whisper_repo(name: str) -> str:
+    return f"Systran/faster-whisper-{name}"
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """Закреплённые ревизии моделей на томе и проверка их целостности."""
+
+    def __init__(self, root: str):
+        self.manifest_path = os.path.join(root, "manifest.json")
+        # _lock — только чтение и правка манифеста; скачивание и сверка хешей идут
+        # под блокировкой своего репозитория и не держат остальные модели
+        self._lock = threading.Lock()
+        self._repo_locks: dict = {}
+        self.manifest = self._read()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        # Том общий у бота и воркеров — дописываем поверх того, что на диске
+        manifest = {**self._read(), **self.manifest}
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    @staticmethod
+    def _snapshot(repo_id: str, **kwargs) -> str:
+        from huggingface_hub import snapshot_download
+
+        if repo_id == PUNCT_REPO:
+            kwargs["ignore_patterns"] = PUNCT_IGNORE
+        else:
+            kwargs["allow_patterns"] = WHISPER_FILES
+        return snapshot_download(repo_id, **kwargs)
+
+    @staticmethod
+    def _verify(path: str, files: dict) -> bool:
+        for name, meta in files.items():
+            file_path = os.path.join(path, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return False
+            if stat.st_size != meta["size"]:
+                return False
+            if meta.get("mtime") != stat.st_mtime_ns:
+                if sha256_file(file_path) != meta["sha256"]:
+                    return False
+                meta["mtime"] = stat.st_mtime_ns
+        return True
+
+    @staticmethod
+    def _pin(path: str) -> dict:
+        files = {}
+        for dirpath, _, names in os.walk(path):
+            for name in names:
+                file_path = os.path.join(dirpath, name)
+                stat = os.stat(file_path)
+                files[os.path.relpath(file_path, path)] = dict(
+                    sha256=sha256_file(file_path),
+                    size=stat.st_size,
+                    mtime=stat.st_mtime_ns,
+                )
+        # Снапшот лежит в .../snapshots/<commit>
+        revision = os.path.basename(os.path.normpath(path))
+        return dict(revision=revision, files=files)
+
+    def _update(self, repo_id: str, pinned: dict):
+        with self._lock:
+            self.manifest[repo_id] = pinned
+            self._save()
+
+    def path(self, repo_id: str) -> str:
+        """Локальный путь модели; сеть — только если её нет на диске или она испорчена."""
+        with self._lock:
+            repo_lock = self._repo_locks.setdefault(repo_id, threading.Lock())
+        with repo_lock:
+            with self._lock:
+                pinned = self.manifest.get(repo_id)
+                if pinned is not None:
+                    # Копия: _verify обновляет mtime, а манифест читают другие потоки
+                    pinned = dict(
+                        revision=pinned["revision"],
+                        files={k: dict(v) for k, v in pinned["files"].items()},
+                    )
+            if pinned is None:
+                if MODELS_OFFLINE:
+                    raise RuntimeError(f"{repo_id} не скачана, а MODELS_OFFLINE=true")
+                logger.info(f"[MODELS] скачиваю {repo_id}...")
+                path = self._snapshot(repo_id)
+                pinned = self._pin(path)
+                self._update(repo_id, pinned)
+                logger.info(
+                    f"[MODELS] {repo_id} закреплена на {pinned['revision'][:8]}"
+                )
+                return path
+            revision = pinned["revision"]
+            try:
+                path = self._snapshot(repo_id, revision=revision, local_files_only=True)
+            except Exception:
+                path = None
+            if path is None or not self._verify(path, pinned["files"]):
+                if MODELS_OFFLINE:
+                    raise RuntimeError(
+                        f"{repo_id}@{revision[:8]} нет на диске или файлы повреждены"
+                    )
+                logger.warning(f"[MODELS] {repo_id}@{revision[:8]}: перекачиваю")
+                path = self._snapshot(repo_id, revision=revision, force_download=True)
+                if not self._verify(path, pinned["files"]):
+                    raise RuntimeError(f"{repo_id}: контрольные суммы не сходятся")
+            self._update(repo_id, pinned)
+            return path
+
+    def prefetch(self, interval: float = 60):
+        """Докачивает AVAILABLE_MODELS по одной, пока очередь пуста."""
+        while True:
+            time.sleep(interval)
+            missing = [
+                name
+                for name in AVAILABLE_MODELS
+                if whisper_repo(name) not in self.manifest
+            ]
+            if not missing:
+                logger.info("[MODELS] все модели на диске")
+                return
+            if scheduler.pending or scheduler.active:
+                continue
+            try:
+                self.path(whisper_repo(missing[0]))
+            except Exception as e:
+                logger.warning(f"[MODELS] докачка {missing[0]}: {e}")
+                # Hub недоступен — не стучимся каждую минуту
+                time.sleep(interval * 30)
+
+
+artifacts = ArtifactStore(MODELS_DIR)
+
+
+def model_path(name: str) -> str:
+    return artifacts.path(whisper_repo(name))
+
+
+def build_model(
+    model_size: str, workers: int = TRANSCRIBE_SLOTS, path: Optional[str] = None
+) -> WhisperModel:
+    return WhisperModel(
+        path or model_path(model_size),
+        device="cpu",
+        compute_type="int8",
+        cpu_threads=WHISPER_THREADS,
+        num_workers=workers,
+    )
+
+
+def retire_model(name: str, whisper: Optional[WhisperModel]):
+    """Снятая модель живёт, пока её держат задания в работе, и ещё находится по имени."""
+    if whisper is None:
+        return
+    retired_models[name] = whisper
+    weakref.finalize(whisper, logger.info, f"Модель {name} выгружена")
+
+
+def load_model(model_size: str):
+    """Новая модель грузится, пока старая обслуживает голосовые, затем ссылка
+    подменяется. Задания в работе держат свою ссылку на старую и доделывают на ней."""
+    global model
+    # В режиме процессов модели Whisper живут только в исполнителях, с воркерами — у них
+    if INFERENCE_PROCESSES or REMOTE:
+        r.set("model", model_size)
+        return
+    # Уже резидентная (по маршрутам, наготове или ещё не выгруженная) — без загрузки
+    new_model = (
+        route_models.get(model_size)
+        or standby_models.pop(model_size, None)
+        or retired_models.get(model_size)
+    )
+    if new_model is None:
+        # Старая модель ещё обслуживает голосовые — в бюджет должны влезть обе
+        memory_budget.reserve(model_size)
+        before = memory_footprint()
+        new_model = build_model(model_size)
+        # Прогрев до подмены — первое голосовое на новой модели не ждёт аллокаций
+        warm_up(new_model, model_size)
+        memory_budget.measure(model_size, before)
+    old_name = r.get("model") or MODEL_SIZE
+    old_model, model = model, new_model
+    r.set("model", model_size)
+    retire_model(old_name, old_model)
+    del old_model
+    gc.collect()
+    logger.info(
+        f"Модель {model_size} загружена "
+        f"({TRANSCRIBE_SLOTS} слот(ов) × {WHISPER_THREADS} потоков)"
+    )
+
+
+def load_punctuation_model():
+    global punct_model
+    logger.info("Загружаю модель пунктуации...")
+    # transformers и torch импортируются секунды — не на старте, а здесь, в фоне
+    import torch
+    from deepmultilingualpunctuation import PunctuationModel
+
+    punct_model = PunctuationModel(model=artifacts.path(PUNCT_REPO))
+    # torch по умолчанию берёт все ядра — ограничиваем долей одного слота
+    torch.set_num_threads(WHISPER_THREADS)
+    logger.info("Модель пунктуации загружена")
+
+
+# ==================== Маршрутизация по длительности ====================
+# Короткие «ок, буду» не нужно гонять через medium: правила [[макс. секунд, модель], ...]
+# в Redis направляют их в резидентные модели поменьше, остальное — в основную
+route_models: dict = {}
+# Снятые с маршрутов и сменённые модели, пока их ещё дорабатывают задания
+retired_models = weakref.WeakValueDictionary()
+
+
+def get_routes() -> list:
+    try:
+        return json.loads(r.get("model_routes") or "[]")
+    except Exception:
+        return []
+
+
+def set_routes(routes: list):
+    r.set("model_routes", json.dumps(sorted(routes)))
+
+
+def load_route_models():
+    """Держит в памяти ровно те модели, на которые ссылаются правила."""
+    main = r.get("model") or MODEL_SIZE
+    wanted = {name for _, name in get_routes()}
+    wanted |= {DEGRADE_MODEL, ESCALATE_MODEL, PREVIEW_MODEL}
+    wanted -= {main, ""}
+    # Сначала новые, потом снятие лишних — маршруты не остаются без модели
+    for name in wanted - route_models.keys():
+        # В режиме процессов и с воркерами здесь только имена — модели строят они
+        if INFERENCE_PROCESSES or REMOTE:
+            route_models[name] = None
+        elif name in retired_models:
+            route_models[name] = retired_models[name]
+        else:
+            try:
+                memory_budget.reserve(name)
+            except MemoryError as e:
+                # Без модели маршрут просто ведёт в основную
+                logger.warning(f"[MEMORY] {e}")
+                continue
+            before = memory_footprint()
+            whisper = build_model(name)
+            warm_up(whisper, name)
+            memory_budget.measure(name, before)
+            route_models[name] = whisper
+        logger.info(f"Модель {name} для коротких голосовых загружена")
+    for name in list(route_models):
+        if name not in wanted:
+            retire_model(name, route_models.pop(name))
+    gc.collect()
+
+
+def route_model(duration) -> str:
+    """Имя модели для голосового такой длительности."""
+    if duration is not None:
+        for max_seconds, name in get_routes():
+            if duration <= max_seconds:
+                if name in route_models:
+                    memory_budget.touch(name)
+                    return name
+                break
+    return r.get("model") or MODEL_SIZE
+
+
+def resolve_model(name) -> Optional[WhisperModel]:
+    """Модель по имени в текущем процессе; нет такой резидентной — основная.
+
+    Готовый WhisperModel возвращается как есть (прогрев ещё не подменённой модели).
+    """
+    if isinstance(name, WhisperModel):
+        return name
+    return (
+        route_models.get(name)
+        or standby_models.get(name)
+        or retired_models.get(name)
+        or model
+    )
+
+
+def resident_models() -> set:
+    return {r.get("model") or MODEL_SIZE, *route_models, *standby_models}
+
+
+def adhoc_model(name: str) -> WhisperModel:
+    """Нерезидентная модель на одно задание (/retranscribe).
+
+    Пока вызывающий держит ссылку, resolve_model находит её в retired_models;
+    после задания её выгружает сборщик мусора.
+    """
+    whisper = retired_models.get(name)
+    if whisper is not None:
+        return whisper
+    # Ради разового задания резидентные модели не выселяем
+    if not memory_budget.fits(name):
+        raise MemoryError(f"не хватает памяти под {name}")
+    whisper = build_model(name, workers=1)
+    retire_model(name, whisper)
+    logger.info(f"Модель {name} собрана на одно задание")
+    return whisper
+
+
+def load_models():
+    """Стартовая загрузка. Пунктуация первой — прогрев Whisper проходит и через неё."""
+    if not REMOTE:
+        load_punctuation_model()
+    load_model(r.get("model") or MODEL_SIZE)
+    load_route_models()
+
+
+# ==================== Предзагрузка для /model ====================
+# Смена small → large-v3 — это гигабайты чтения с тома. Веса вероятных следующих
+# моделей периодически перечитываются в page cache (в пределах PRELOAD_CACHE_MB),
+# а с STANDBY_MODEL первая из них держится собранной и прогретой — /model просто
+# подменяет ссылку.
+standby_models: dict = {}
+
+
+def mem_available() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class ModelPreloader:
+    """Держит веса вероятных следующих моделей в page cache."""
+
+    def __init__(self, cache_bytes: int, standby: bool, interval: float = 600):
+        self.cache_bytes = cache_bytes
+        self.standby = standby
+        self.interval = interval
+        self.warm: list = []
+
+    def candidates(self) -> list:
+        main = r.get("model") or MODEL_SIZE
+        if PRELOAD_MODELS != "auto":
+            names = [n.strip() for n in PRELOAD_MODELS.split(",") if n.strip()]
+        else:
+            # Недавние цели /model, затем соседи — сначала покрупнее: их дольше читать
+            i = AVAILABLE_MODELS.index(main) if main in AVAILABLE_MODELS else 0
+            names = r.lrange("model_history", 0, -1)
+            names += (
+                AVAILABLE_MODELS[i + 1 : i + 2] + AVAILABLE_MODELS[max(0, i - 1) : i]
+            )
+        seen, result = {main, *route_models}, []
+        for name in names:
+            if name in AVAILABLE_MODELS and name not in seen:
+                seen.add(name)
+                result.append(name)
+        return result
+
+    @staticmethod
+    def model_bytes(name: str) -> int:
+        pinned = artifacts.manifest.get(whisper_repo(name))
+        return sum(f["size"] for f in pinned["files"].values()) if pinned else 0
+
+    @staticmethod
+    def read_through(path: str):
+        buf = bytearray(8 * 1024 * 1024)
+        for dirpath, _, names in os.walk(path):
+            for name in names:
+                with open(os.path.join(dirpath, name), "rb", buffering=0) as f:
+                    while f.readinto(buf):
+                        pass
+
+    def step(self):
+        budget, warm = self.cache_bytes, []
+        candidates = self.candidates()
+        if not lifecycle.loaded:
+            # Модели выгружены по простою — держим тёплой основную, чтобы вернуть быстро
+            candidates.insert(0, r.get("model") or MODEL_SIZE)
+        for name in candidates:
+            size = self.model_bytes(name)
+            # Не скачанные не трогаем — это дело докачки в простое
+            if not size or size > budget:
+                continue
+            self.read_through(model_path(name))
+            budget -= size
+            warm.append(name)
+        self.warm = warm
+        if not self.standby or not lifecycle.loaded:
+            return
+        top = candidates[0] if candidates else None
+        for name in list(standby_models):
+            if name != top:
+                del standby_models[name]
+                gc.collect()
+        size = self.model_bytes(top) if top else 0
+        # Собранная int8-модель занимает около размера файлов; запас — вдвое.
+        # Ради запасной модели ничего не выселяем
+        if (
+            size
+            and top not in standby_models
+            and mem_available() > 2 * size
+            and memory_budget.fits(top)
+        ):
+            before = memory_footprint()
+            whisper = build_model(top)
+            warm_up(whisper, top)
+            memory_budget.measure(top, before)
+            standby_models[top] = whisper
+            logger.info(f"[PRELOAD] {top} наготове")
+
+    def run(self):
+        while True:
+            if not (scheduler.pending or scheduler.active):
+                try:
+                    self.step()
+                except Exception as e:
+                    logger.warning(f"[PRELOAD] {e}")
+            time.sleep(self.interval)
+
+    def stats(self) -> str:
+        warm = ", ".join(self.warm) or "—"
+        ready = ", ".join(standby_models) or "—"
+        return f"в page cache {warm}; наготове {ready}"
+
+
+# Исполнители строят модели сами — собранная в этом процессе им не поможет
+preloader = ModelPreloader(
+    PRELOAD_CACHE_MB * 1024 * 1024, STANDBY_MODEL and not INFERENCE_PROCESSES
+)
+
+
+# ==================== Бюджет памяти ====================
+# large-v3 + пунктуация + задания в работе легко упираются в лимит контейнера, а
+# OOM-kill хуже отказа. Перед сборкой каждой модели её размер (замеренный прирост
+# RSS при прошлой сборке, иначе оценка по файлам) сверяется с бюджетом: не
+# влезает — выселяются запасная и давно не нужные резидентные модели (LRU), затем
+# ожидание, пока задания отпустят снятые модели, и только потом отказ.
+def cgroup_memory_limit() -> int:
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # Без лимита: "max" (v2) или почти 2^63 (v1)
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class MemoryBudget:
+    """Учёт размера моделей и решения: загрузить, выселить, подождать или отказать."""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.decisions: deque = deque(maxlen=5)
+        self._used_at: dict = {}
+
+    def estimate(self, name: str) -> int:
+        measured = r.hget("model_rss", name)
+        if measured:
+            return int(measured)
+        return int(ModelPreloader.model_bytes(name) * 1.3)
+
+    def measure(self, name: str, before: int):
+        r.hset("model_rss", name, max(0, memory_footprint() - before))
+
+    def touch(self, name: str):
+        self._used_at[name] = time.monotonic()
+
+    def need(self, name: str) -> int:
+        # В режиме процессов модель есть в каждом исполнителе
+        return self.estimate(name) * (inference_pool.workers if inference_pool else 1)
+
+    def fits(self, name: str) -> bool:
+        return memory_footprint() + self.need(name) <= self.budget
+
+    def _decide(self, text: str):
+        self.decisions.append(f"{time.strftime('%H:%M')} {text}")
+        logger.info(f"[MEMORY] {text}")
+
+    def _victim(self, keep: tuple) -> Optional[str]:
+        if standby_models:
+            return next(iter(standby_models))
+        loaded = [n for n, m in route_models.items() if m is not None and n not in keep]
+        return min(loaded, key=lambda n: self._used_at.get(n, 0), default=None)
+
+    def reserve(self, *names: str, wait: float = 60):
+        """Освобождает место под модели names или бросает MemoryError."""
+        need = sum(self.need(name) for name in names)
+        name = ", ".join(names)
+        deadline = time.monotonic() + wait
+        waiting = False
+        while memory_footprint() + need > self.budget:
+            victim = self._victim(keep=names)
+            if victim is not None:
+                if victim in standby_models:
+                    del standby_models[victim]
+                else:
+                    retire_model(victim, route_models.pop(victim))
+                gc.collect()
+                malloc_trim()
+                self._decide(f"выселена {victim} ради {name}")
+                continue
+            if len(retired_models) and time.monotonic() < deadline:
+                # Снятые модели ещё держат задания в работе — освободятся сами
+                if not waiting:
+                    self._decide(f"{name} ждёт, пока задания отпустят старые модели")
+                    waiting = True
+                time.sleep(1)
+                gc.collect()
+                continue
+            free = max(0, self.budget - memory_footprint())
+            self._decide(f"отказ: {name}")
+            raise MemoryError(
+                f"не хватает памяти под {name}: нужно ~{need / 2**30:.1f} ГБ, "
+                f"свободно {free / 2**30:.1f} из {self.budget / 2**30:.1f} ГБ бюджета"
+            )
+        self._decide(f"загружается {name} (~{need / 2**30:.1f} ГБ)")
+
+    def stats(self) -> str:
+        used = memory_footprint()
+        text = f"{used / 2**30:.1f} из {self.budget / 2**30:.1f} ГБ"
+        if self.decisions:
+            text += "\n  " + "\n  ".join(self.decisions)
+        return text
+
+
+memory_budget = MemoryBudget(
+    MEMORY_BUDGET_MB * 1024 * 1024 or int(cgroup_memory_limit() * MEMORY_BUDGET_SHARE)
+)
+
+
+# ==================== Форматирование ====================
+def format_text(text: str) -> str:
+    if not text or text == "…" or punct_model is None:
+        return text
+    try:
+        formatted = punct_model.restore_punctuation(text)
+        sentences = re.split(r"(?<=[.!?])\s+", formatted)
+        paragraphs, current = [], []
+        for sentence in sentences:
+            current.append(sentence)
+            if len(current) >= 4:
+                paragraphs.append(" ".join(current))
+                current = []
+        if current:
+            paragraphs.append(" ".join(current))
+        return "\n\n".join(paragraphs)
+    except Exception as e:
+        logger.error(f"Ошибка форматирования: {e}")
+        return text
+
+
+# ==================== Транскрипция ====================
+SAMPLE_RATE = 16000
+WHISPER_OPTIONS = dict(
+    language=None if WHISPER_LANGUAGE == "auto" else WHISPER_LANGUAGE,
+    beam_size=5,
+    vad_filter=True,
+    vad_parameters=dict(min_silence_duration_ms=500, speech_pad_ms=400),
+    # Тайминги слов — лишний проход выравнивания; считаются только по /timestamps
+    word_timestamps=False,
+)
+
+
+class Transcript(NamedTuple):
+    text: str
+    language: Optional[str] = None
+    language_probability: float = 0.0
+    avg_logprob: Optional[float] = None
+    # Время самого инференса, с — без ожидания в очередях и без пунктуации
+    seconds: float = 0.0
+
+
+def load_audio(audio) -> np.ndarray:
+    """PCM 16 кГц из массива, пути к файлу или байтов ogg (декодируются из памяти)."""
+    if isinstance(audio, np.ndarray):
+        return audio
+    if isinstance(audio, (bytes, bytearray)):
+        audio = io.BytesIO(audio)
+    return decode_audio(audio, sampling_rate=SAMPLE_RATE)
+
+
+def finish_text(text: str) -> str:
+    return format_text(text) if text and text != "…" else (text or "…")
+
+
+def low_confidence(seg) -> bool:
+    return (
+        seg.avg_logprob < ESCALATE_LOGPROB
+        or seg.compression_ratio > ESCALATE_COMPRESSION
+        or seg.no_speech_prob > ESCALATE_NO_SPEECH
+    )
+
+
+def escalate(audio: np.ndarray, spans: list, model_name, language) -> Optional[str]:
+    """Текст, где неуверенные сегменты распознаны заново ESCALATE_MODEL.
+
+    spans — [(начало, конец, текст, неуверенный), ...]. Соседние неуверенные идут
+    одним куском: больше контекста и меньше вызовов. Куски берутся с запасом
+    ESCALATE_PAD: повторившиеся на их краях слова убирает stitch_chunks, а
+    нетронутые сегменты склеиваются как есть. None —
+    переспрашивать некого или нечего.
+    """
+    if not any(low for *_, low in spans) or model_name not in AVAILABLE_MODELS:
+        return None
+    # Черновику нужна скорость, уточнит его основная модель
+    if model_name == PREVIEW_MODEL:
+        return None
+    if AVAILABLE_MODELS.index(model_name) >= AVAILABLE_MODELS.index(ESCALATE_MODEL):
+        return None
+    main = r.get("model") or MODEL_SIZE
+    bigger = model if main == ESCALATE_MODEL else route_models.get(ESCALATE_MODEL)
+    if bigger is None:
+        return None
+    texts = [text for _, _, text, _ in spans]
+    retried = [False] * len(spans)
+    escalated, seconds, i = 0, 0.0, 0
+    while i < len(spans):
+        if not spans[i][3]:
+            i += 1
+            continue
+        j = i
+        while j + 1 < len(spans) and spans[j + 1][3]:
+            j += 1
+        start = max(0, int((spans[i][0] - ESCALATE_PAD) * SAMPLE_RATE))
+        end = int((spans[j][1] + ESCALATE_PAD) * SAMPLE_RATE)
+        segments, _ = bigger.transcribe(
+            audio[start:end],
+            language=language,
+            beam_size=WHISPER_OPTIONS["beam_size"],
+            vad_filter=False,
+            condition_on_previous_text=False,
+            # Уверенный текст перед куском — подсказка для имён и терминов
+            initial_prompt=" ".join(texts[max(0, i - 2) : i]) or None,
+        )
+        retry = " ".join(seg.text.strip() for seg in segments)
+        texts[i : j + 1] = [retry] + [""] * (j - i)
+        retried[i] = True
+        escalated += j - i + 1
+        seconds += (end - start) / SAMPLE_RATE
+        i = j + 1
+    pipe = r.pipeline()
+    pipe.hincrby("escalate", "escalated", escalated)
+    pipe.hincrbyfloat("escalate", "seconds", seconds)
+    pipe.execute()
+    logger.info(
+        f"[ESCALATE] {escalated} из {len(spans)} сегментов → {ESCALATE_MODEL} "
+        f"({seconds:.1f} с аудио)"
+    )
+    result, after_retry = "", False
+    for text, is_retry in zip(texts, retried):
+        if not text:
+            continue
+        if is_retry or after_retry:
+            result = stitch_chunks([result, text])
+        else:
+            result = f"{result} {text}".lstrip()
+        after_retry = is_retry
+    return result
+
+
+def transcribe_file_sync(audio, model_name=None, options=None, on_text=None):
+    """audio — путь к файлу или уже декодированный PCM 16 кГц (np.ndarray)."""
+    started = time.monotonic()
+    whisper = resolve_model(model_name)
+    if whisper is None:
+        return Transcript("Ошибка: модель не загружена")
+    try:
+        segments, info = whisper.transcribe(audio, **(options or WHISPER_OPTIONS))
+        parts, logprobs, spans = [], [], []
+        # segments — ленивый генератор: декодирование идёт по мере итерации
+        for seg in segments:
+            parts.append(seg.text.strip())
+            logprobs.append(seg.avg_logprob)
+            spans.append((seg.start, seg.end, parts[-1], low_confidence(seg)))
+            if on_text is not None:
+                on_text(" ".join(parts))
+        text = None
+        if ESCALATE_MODEL and isinstance(audio, np.ndarray):
+            # Доля в /status — от всех сегментов, не только у голосовых с эскалацией
+            r.hincrby("escalate", "segments", len(spans))
+            text = escalate(audio, spans, model_name, info.language)
+        return Transcript(
+            text or " ".join(parts).strip(),
+            info.language,
+            info.language_probability,
+            sum(logprobs) / len(logprobs) if logprobs else None,
+            time.monotonic() - started,
+        )
+    except Exception as e:
+        logger.error(f"Ошибка транскрипции: {e}", exc_info=True)
+        return Transcript(f"Ошибка: {e}")
+
+
+def word_timestamps_sync(audio, model_name, language) -> list:
+    """[[(начало слова, слово), ...] по сегментам]."""
+    options = {**WHISPER_OPTIONS, "language": language, "word_timestamps": True}
+    segments, _ = resolve_model(model_name).transcribe(audio, **options)
+    return [[(w.start, w.word.strip()) for w in seg.words or []] for seg in segments]
+
+
+def decode_batch(audios: list, whisper: WhisperModel, options: dict) -> list:
+    """Один проход энкодера и декодера по нескольким клипам до 30 секунд.
+
+    Возвращает [(текст, язык, вероятность языка, avg_logprob), ...].
+    """
+    extractor = whisper.feature_extractor
+    features = np.stack(
+        [extractor(audio)[:, : extractor.nb_max_frames] for audio in audios]
     )
-    sys.exit(1)
+    encoder_output = whisper.model.encode(
+        ctranslate2.StorageView.from_array(np.ascontiguousarray(features))
+    )
+    if options["language"] is None and whisper.model.is_multilingual:
+        # Первый элемент — самый вероятный язык: ("<|ru|>", 0.97)
+        languages = [
+            (token[2:-2], prob)
+            for (token, prob), *_ in whisper.model.detect_language(encoder_output)
+        ]
+    else:
+        languages = [(options["language"] or "en", 1.0)] * len(audios)
+    tokenizers = {
+        language: Tokenizer(
+            whisper.hf_tokenizer,
+            whisper.model.is_multilingual,
+            task="transcribe",
+            language=language,
+        )
+        for language, _ in languages
+    }
+    prompts = [
+        whisper.get_prompt(tokenizers[language], [], without_timestamps=True)
+        for language, _ in languages
+    ]
+    results = whisper.model.generate(
+        encoder_output,
+        prompts,
+        beam_size=options["beam_size"],
+        max_length=whisper.max_length,
+        suppress_blank=True,
+        suppress_tokens=[-1],
+        return_scores=True,
+        return_no_speech_prob=True,
+    )
+    decoded = []
+    for result, (language, prob) in zip(results, languages):
+        tokens = result.sequences_ids[0]
+        avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+        text = ""
+        if result.no_speech_prob <= 0.6:
+            text = tokenizers[language].decode(tokens).strip()
+        decoded.append((text, language, prob, avg_logprob))
+    return decoded
+
+
+def pack_clips(lengths: list, capacity: int, gap: int) -> list:
+    """Номера клипов по окнам длиной capacity сэмплов (first-fit decreasing)."""
+    windows: list = []  # [свободно сэмплов, [номера]]
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for window in windows:
+            if window[0] >= lengths[i] + gap:
+                window[0] -= lengths[i] + gap
+                window[1].append(i)
+                break
+        else:
+            windows.append([capacity - lengths[i], [i]])
+    return [sorted(indices) for _, indices in windows]
+
+
+def transcribe_packed_sync(audios: list, whisper: WhisperModel, options: dict) -> list:
+    """Клипы одним окном через паузы PACK_GAP: энкодер считается один раз на всех.
+
+    Слово достаётся клипу, в чьи границы (до середин пауз) попала его середина.
+    Возвращает [(текст, avg_logprob), ...].
+    """
+    gap = np.zeros(int(PACK_GAP * SAMPLE_RATE), dtype=np.float32)
+    parts, offsets, position = [], [], 0
+    for audio in audios:
+        if parts:
+            parts.append(gap)
+            position += len(gap)
+        offsets.append(position / SAMPLE_RATE)
+        parts.append(audio)
+        position += len(audio)
+    bounds = np.array(offsets[1:]) - PACK_GAP / 2
+    # VAD выкинул бы паузы-разделители; контекст соседнего клипа только мешает
+    segments, _ = whisper.transcribe(
+        np.concatenate(parts),
+        **{
+            **options,
+            "vad_filter": False,
+            "word_timestamps": True,
+            "condition_on_previous_text": False,
+        },
+    )
+    words: list = [[] for _ in audios]
+    logprobs: list = [[] for _ in audios]
+    for seg in segments:
+        for word in seg.words or []:
+            i = int(np.searchsorted(bounds, (word.start + word.end) / 2, "right"))
+            words[i].append(word.word)
+            logprobs[i].append(seg.avg_logprob)
+    return [
+        ("".join(w).strip(), sum(lp) / len(lp) if lp else None)
+        for w, lp in zip(words, logprobs)
+    ]
+
+
+def transcribe_batch_sync(items: list, model_name=None, options=None) -> list:
+    started = time.monotonic()
+    whisper = resolve_model(model_name)
+    options = options or WHISPER_OPTIONS
+    if whisper is None:
+        return [Transcript("Ошибка: модель не загружена")] * len(items)
+    if len(items) == 1:
+        return [transcribe_file_sync(items[0], model_name, options)]
+
+    # Короткие клипы (≤30 с) — в общий батч, длинные — обычным путём с VAD
+    results, short = [None] * len(items), []
+    for i, item in enumerate(items):
+        try:
+            audio = load_audio(item)
+        except Exception as e:
+            logger.error(f"Ошибка декодирования {item}: {e}")
+            results[i] = Transcript(f"Ошибка: {e}")
+            continue
+        if len(audio) <= whisper.feature_extractor.n_samples:
+            short.append((i, audio))
+        else:
+            results[i] = transcribe_file_sync(audio, model_name, options)
+
+    # Окно декодируется на одном языке — без заданного клипы не смешиваем
+    if PACK_VOICES and options["language"] is not None and len(short) > 1:
+        windows = pack_clips(
+            [len(audio) for _, audio in short],
+            whisper.feature_extractor.n_samples,
+            int(PACK_GAP * SAMPLE_RATE),
+        )
+        unpacked = []
+        for window in windows:
+            clips = [short[k] for k in window]
+            if len(clips) == 1:
+                unpacked.extend(clips)
+                continue
+            try:
+                packed = transcribe_packed_sync(
+                    [audio for _, audio in clips], whisper, options
+                )
+            except Exception as e:
+                logger.error(f"Ошибка упаковки, обычным батчем: {e}", exc_info=True)
+                unpacked.extend(clips)
+                continue
+            for (i, _), (text, avg_logprob) in zip(clips, packed):
+                results[i] = Transcript(text, options["language"], 1.0, avg_logprob)
+            r.hincrby("pack", "clips", len(clips))
+            r.hincrby("pack", "windows", 1)
+            logger.info(f"[PACK] {len(clips)} голосовых в одном окне")
+        short = unpacked
+
+    if short:
+        try:
+            decoded = decode_batch([audio for _, audio in short], whisper, options)
+            logger.info(f"[BATCH] {len(short)} голосовых за один проход")
+        except Exception as e:
+            logger.error(f"Ошибка батча, по одному: {e}", exc_info=True)
+            decoded = None
+        for n, (i, _) in enumerate(short):
+            if decoded is None:
+                results[i] = transcribe_file_sync(items[i], model_name, options)
+                continue
+            text, language, prob, avg_logprob = decoded[n]
+            results[i] = Transcript(text, language, prob, avg_logprob)
+    # Проход общий — время делится между голосовыми батча поровну
+    share = (time.monotonic() - started) / len(items)
+    return [result._replace(seconds=share) for result in results]
+
+
+class VoiceBatcher:
+    """Копит голосовые в течение окна и отдаёт их в transcribe_batch_sync разом."""
+
+    def __init__(self, max_size: int, window: float):
+        self.max_size = max_size
+        self.window = window
+        self._pending: list = []
+        self._timer = None
+        # Ссылки на запущенные батчи — чтобы asyncio tasks не собрал GC
+        self._running: set = set()
+
+    async def transcribe(self, audio, model_name, options) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((audio, model_name, options, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        # Один батч — одна модель и одни настройки: маршрутизация и адаптивное
+        # качество могли развести голосовые по разным
+        groups: dict = {}
+        for audio, model_name, options, future in pending:
+            key = (model_name, json.dumps(options, sort_keys=True))
+            groups.setdefault(key, (model_name, options, []))[2].append((audio, future))
+        for model_name, options, batch in groups.values():
+            task = asyncio.create_task(self._run(batch, model_name, options))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: list, model_name, options):
+        try:
+            texts = await run_inference(
+                transcribe_batch_sync,
+                [audio for audio, _ in batch],
+                model_name,
+                options,
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
+
+
+batcher = VoiceBatcher(BATCH_SIZE, BATCH_WINDOW) if BATCH_SIZE > 1 else None
+
+
+class PartialTranscript:
+    """Раз в interval секунд передаёт в edit текст, распознанный к этому моменту."""
+
+    def __init__(self, edit, interval: float):
+        self._edit = edit
+        self.interval = interval
+        self._text = ""
+        self._shown = ""
+        self._stopped = asyncio.Event()
+
+    def push(self, text: str):
+        # Вызывается из потока executor — простое присваивание атомарно под GIL
+        self._text = text
+
+    async def run(self):
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            text = self._text
+            if text and text != self._shown and not self._stopped.is_set():
+                self._shown = text
+                try:
+                    await self._edit(text)
+                except Exception as e:
+                    logger.debug(f"[STREAM] не удалось обновить: {e}")
+
+    def stop(self):
+        self._stopped.set()
+
+
+def partial_text(text: str, limit: int) -> str:
+    text = f"⏳ {text}"
+    return text if len(text) <= limit else "⏳ …" + text[-(limit - 4) :]
+
+
+def transcription_failed(text: str) -> bool:
+    return text.startswith("Ошибка")
+
+
+# ==================== Прогрев ====================
+def warm_up(whisper: WhisperModel, name: str):
+    """Синтетический клип через transcribe_file_sync и format_text: аллокации, пулы
+    потоков CTranslate2 и torch, инициализация VAD — до первого настоящего голосового.
+    Время пишется в Redis (прогревают и исполнители, и воркеры) и видно в /status."""
+    started = time.monotonic()
+    clip = np.random.default_rng(0).normal(0, 0.05, 2 * SAMPLE_RATE)
+    clip = clip.astype(np.float32)
+    # С VAD шум отсеивается целиком, но модель silero загружается
+    transcribe_file_sync(clip, whisper)
+    # Без VAD — полный проход энкодера, детекции языка и декодера
+    transcribe_file_sync(clip, whisper, {**WHISPER_OPTIONS, "vad_filter": False})
+    format_text("проверка связи раз два три")
+    seconds = time.monotonic() - started
+    r.hset("warmup", name, f"{seconds:.1f}")
+    logger.info(f"[WARMUP] {name}: {seconds:.1f} с")
+
+
+# ==================== Процессы-исполнители ====================
+# При INFERENCE_PROCESSES инференс идёт в TRANSCRIBE_SLOTS дочерних процессах:
+# OOM-kill или падение в нативном коде убивает исполнителя, а не клиент Telegram.
+# Форк — из процесса, где инференса не было: пул потоков CTranslate2 и OpenMP
+# через fork не переживают, поэтому Whisper каждый исполнитель строит сам, а уже
+# загруженная модель пунктуации достаётся всем без копирования (copy-on-write).
+# PCM передаётся через shared memory, а не пиклингом.
+_partial_queue = None
+
+
+class SharedArray(NamedTuple):
+    name: str
+    shape: tuple
+    dtype: str
+
+
+def _share(value, segments: list):
+    """np.ndarray (в т.ч. в списке) → SharedArray в новом сегменте shared memory."""
+    if isinstance(value, list):
+        return [_share(item, segments) for item in value]
+    if not isinstance(value, np.ndarray):
+        return value
+    shm = shared_memory.SharedMemory(create=True, size=max(1, value.nbytes))
+    segments.append(shm)
+    np.ndarray(value.shape, value.dtype, buffer=shm.buf)[:] = value
+    return SharedArray(shm.name, value.shape, value.dtype.str)
+
+
+def _attach(value, segments: list):
+    if isinstance(value, list):
+        return [_attach(item, segments) for item in value]
+    if not isinstance(value, SharedArray):
+        return value
+    shm = shared_memory.SharedMemory(name=value.name)
+    segments.append(shm)
+    return np.ndarray(value.shape, value.dtype, buffer=shm.buf)
+
+
+def _inference_worker_init(model_size: str, paths: dict, queue):
+    # Выполняется в исполнителе сразу после fork. Пути к моделям разрешены заранее:
+    # блокировка манифеста могла быть захвачена другим потоком в момент fork
+    global model, _partial_queue
+    _partial_queue = queue
+    for name, path in paths.items():
+        # Параллелизм — число процессов, внутри каждого одна реплика
+        whisper = build_model(name, workers=1, path=path)
+        warm_up(whisper, name)
+        if name == model_size:
+            model = whisper
+        else:
+            route_models[name] = whisper
+
+
+def _inference_call(fn, args: list, job_id):
+    segments: list = []
+    args = _attach(args, segments)
+    kwargs = {}
+    if job_id is not None:
+        kwargs["on_text"] = lambda text: _partial_queue.put((job_id, text))
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        del args
+        for shm in segments:
+            try:
+                shm.close()
+            except BufferError:
+                # На буфер ещё ссылается numpy — отпустит сборщик мусора
+                pass
+
+
+class InferencePool:
+    """Процессы-исполнители; пересоздаются при падении и при смене моделей."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.restarts = 0
+        self._pool = None
+        self._lock = asyncio.Lock()
+        self._ids = itertools.count()
+        # Промежуточный текст из исполнителей: (id задачи, текст)
+        self._partials: dict = {}
+        self._queue = multiprocessing.get_context("fork").SimpleQueue()
+        threading.Thread(target=self._read_partials, daemon=True).start()
+
+    def _read_partials(self):
+        while True:
+            job_id, text = self._queue.get()
+            push = self._partials.get(job_id)
+            if push is not None:
+                push(text)
+
+    def start(self):
+        """Форк исполнителей с текущим набором моделей (блокирует до готовности).
+
+        Пока новые грузят модели, задания идут в старый пул.
+        """
+        main = r.get("model") or MODEL_SIZE
+        names = [main, *route_models]
+        # Старые исполнители живут, пока не поднимутся новые, — нужно место на оба пула
+        memory_budget.reserve(*names)
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_inference_worker_init,
+            initargs=(main, {name: model_path(name) for name in names}, self._queue),
+        )
+        # С fork процессы запускаются на первой задаче — запускаем сразу
+        pool.submit(os.getpid).result()
+        old, self._pool = self._pool, pool
+        if old is not None:
+            # Уже начатые задачи старый пул доделает сам
+            old.shutdown(wait=False)
+        logger.info(f"[WORKERS] {self.workers} процесс(ов) × {WHISPER_THREADS} потоков")
+
+    async def call(self, fn, args: tuple, on_text=None):
+        async with self._lock:
+            if self._pool is None:
+                await asyncio.get_running_loop().run_in_executor(None, self.start)
+            pool = self._pool
+        segments: list = []
+        job_id = next(self._ids) if on_text is not None else None
+        if job_id is not None:
+            self._partials[job_id] = on_text
+        try:
+            future = pool.submit(
+                _inference_call, fn, _share(list(args), segments), job_id
+            )
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            if self._pool is pool:
+                logger.error("[WORKERS] исполнитель упал — пул будет пересоздан")
+                self._pool = None
+                self.restarts += 1
+            raise
+        finally:
+            self._partials.pop(job_id, None)
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+    def stop(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def stats(self) -> str:
+        return f"{self.workers} процесс(ов), перезапусков {self.restarts}"
+
+
+inference_pool = (
+    InferencePool(TRANSCRIBE_SLOTS) if INFERENCE_PROCESSES and not REMOTE else None
+)
+
+
+async def run_inference(fn, *args, on_text=None, pool=None):
+    """fn(*args) в слоте executor или, при INFERENCE_PROCESSES, в исполнителе.
+
+    pool — свой executor вместо общего. Отмена задачи снимает и ещё не начатый вызов.
+    """
+    await lifecycle.acquire()
+    try:
+        if inference_pool is not None:
+            return await inference_pool.call(fn, args, on_text)
+        kwargs = {} if on_text is None else {"on_text": on_text}
+        return await asyncio.get_running_loop().run_in_executor(
+            pool or executor, functools.partial(fn, *args, **kwargs)
+        )
+    finally:
+        lifecycle.release()
+
+
+models_lock = threading.Lock()
+
+
+def reload_models(model_size: Optional[str] = None):
+    """Смена основной модели и/или набора резидентных. Блокирует — не из event loop."""
+    with models_lock:
+        if model_size:
+            r.lpush("model_history", model_size)
+            r.ltrim("model_history", 0, 4)
+        if not lifecycle.loaded:
+            # Выгружены по простою — загрузятся уже новые, с первым голосовым
+            if model_size:
+                r.set("model", model_size)
+            return
+        if model_size:
+            load_model(model_size)
+        load_route_models()
+        if inference_pool is not None:
+            inference_pool.start()
+
+
+# Клиент выходит в онлайн сразу, модели грузятся в фоне; голосовые до готовности
+# ждут в очереди планировщика
+models_ready = threading.Event()
+
+
+def start_models():
+    try:
+        with models_lock:
+            started = time.monotonic()
+            load_models()
+            if inference_pool is not None:
+                inference_pool.start()
+            lifecycle.loaded = True
+    except Exception as e:
+        # Без моделей боту делать нечего — пусть перезапустится контейнер
+        logger.critical(f"❌ Модели не загрузились: {e}", exc_info=True)
+        os._exit(1)
+    models_ready.set()
+    logger.info(f"✅ Модели готовы за {time.monotonic() - started:.1f} с")
+    if MODELS_PREFETCH and not MODELS_OFFLINE and not REMOTE:
+        threading.Thread(
+            target=artifacts.prefetch, name="prefetch", daemon=True
+        ).start()
+    if PRELOAD_CACHE_MB > 0 and not REMOTE:
+        threading.Thread(target=preloader.run, name="preload", daemon=True).start()
+    if MODEL_IDLE_MINUTES > 0 and not REMOTE:
+        threading.Thread(target=lifecycle.run, name="idle", daemon=True).start()
+
+
+# ==================== Выгрузка в простое ====================
+# Ночью бот простаивает, держа в памяти Whisper и трансформер пунктуации. После
+# MODEL_IDLE_MINUTES без инференса модели выгружаются (в режиме процессов —
+# вместе с исполнителями), первое же задание грузит их обратно — веса при этом
+# обычно ещё в page cache, их держит тёплыми предзагрузка.
+def memory_footprint() -> int:
+    """RSS процесса и его дочерних (исполнителей), байт."""
+    total = 0
+    for pid in [os.getpid()] + [p.pid for p in multiprocessing.active_children()]:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def malloc_trim():
+    # Вернуть ОС освобождённую кучу glibc, иначе RSS почти не падает
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class ModelLifecycle:
+    """Счёт заданий в работе, выгрузка по простою и загрузка при первой нужде."""
+
+    def __init__(self, idle_seconds: float):
+        self.idle_seconds = idle_seconds
+        self.loaded = False
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.footprint = None
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        while True:
+            with self._lock:
+                if self.loaded:
+                    self.active += 1
+                    self.last_used = time.monotonic()
+                    return
+            await asyncio.get_running_loop().run_in_executor(None, self.load)
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            self.last_used = time.monotonic()
+
+    def load(self):
+        with models_lock:
+            if self.loaded:
+                return
+            started = time.monotonic()
+            load_models()
+            if inference_pool is not None:
+                inference_pool.start()
+            self.loaded = True
+            logger.info(
+                f"[IDLE] модели снова загружены за {time.monotonic() - started:.1f} с, "
+                f"память {memory_footprint() / 2**30:.1f} ГБ"
+            )
+
+    def unload(self):
+        global model, punct_model
+        with models_lock:
+            with self._lock:
+                idle = time.monotonic() - self.last_used
+                if not self.loaded or self.active or idle < self.idle_seconds:
+                    return
+                self.loaded = False
+            before = memory_footprint()
+            if inference_pool is not None:
+                inference_pool.stop()
+            model = None
+            punct_model = None
+            route_models.clear()
+            standby_models.clear()
+            gc.collect()
+            malloc_trim()
+            after = memory_footprint()
+            self.footprint = (before, after)
+            logger.info(
+                f"[IDLE] {idle / 60:.0f} мин без голосовых — модели выгружены: "
+                f"{before / 2**30:.1f} → {after / 2**30:.1f} ГБ"
+            )
+
+    def run(self):
+        while True:
+            time.sleep(min(60, self.idle_seconds))
+            try:
+                self.unload()
+            except Exception as e:
+                logger.error(f"[IDLE] выгрузка: {e}", exc_info=True)
+
+    def stats(self) -> str:
+        if self.loaded:
+            return f"загружены, память {memory_footprint() / 2**30:.1f} ГБ"
+        if self.footprint is None:
+            return "загружаются"
+        before, after = self.footprint
+        return f"выгружены по простою ({before / 2**30:.1f} → {after / 2**30:.1f} ГБ)"
+
+
+lifecycle = ModelLifecycle(MODEL_IDLE_MINUTES * 60)
+
+
+# ==================== Длинные голосовые ====================
+# Лекция на 30 минут в одном слоте грузит лишь его долю ядер. Режем её по паузам
+# (VAD), куски с небольшим перекрытием распознаются параллельно во всех слотах
+# (потоки executor или процессы-исполнители), затем текст склеивается по порядку.
+def _transcribe_chunk(audio: np.ndarray, model_name: str, options: dict) -> tuple:
+    started = time.monotonic()
+    segments, info = resolve_model(model_name).transcribe(audio, **options)
+    parts, logprobs, spans = [], [], []
+    for seg in segments:
+        parts.append(seg.text.strip())
+        logprobs.append(seg.avg_logprob)
+        spans.append((seg.start, seg.end, parts[-1], low_confidence(seg)))
+    text = None
+    if ESCALATE_MODEL:
+        r.hincrby("escalate", "segments", len(spans))
+        text = escalate(audio, spans, model_name, info.language)
+    return (
+        text or " ".join(parts),
+        info.language,
+        info.language_probability,
+        time.monotonic() - started,
+        logprobs,
+    )
+
+
+def split_on_silence(audio: np.ndarray, target_seconds: float, overlap: float):
+    """Границы кусков [(начало, конец), ...] в сэмплах, разрезы — посреди пауз."""
+    speech = get_speech_timestamps(
+        audio,
+        VadOptions(min_silence_duration_ms=500, max_speech_duration_s=target_seconds),
+    )
+    if not speech:
+        return [(0, len(audio))]
+    target = int(target_seconds * SAMPLE_RATE)
+    spans, start = [], speech[0]["start"]
+    for prev, nxt in zip(speech, speech[1:]):
+        if prev["end"] - start >= target:
+            cut = (prev["end"] + nxt["start"]) // 2
+            spans.append((start, cut))
+            start = cut
+    spans.append((start, speech[-1]["end"]))
+    pad = int(overlap * SAMPLE_RATE)
+    return [(max(0, a - pad), min(len(audio), b + pad)) for a, b in spans]
+
+
+def _norm_word(word: str) -> str:
+    return re.sub(r"\W", "", word.lower())
+
+
+def stitch_chunks(texts: list, max_overlap: int = 12) -> str:
+    """Склейка текстов кусков: слова из перекрытия, попавшие в оба куска, — один раз."""
+    words: list = []
+    for text in texts:
+        new = text.split()
+        skip = 0
+        for k in range(min(max_overlap, len(words), len(new)), 0, -1):
+            if [_norm_word(w) for w in words[-k:]] == [_norm_word(w) for w in new[:k]]:
+                skip = k
+                break
+        words.extend(new[skip:])
+    return " ".join(words)
+
+
+async def transcribe_long(audio: np.ndarray, model_name, options: dict, on_text=None):
+    duration = len(audio) / SAMPLE_RATE
+    target = max(30.0, duration / (2 * TRANSCRIBE_SLOTS))
+    spans = await run_inference(split_on_silence, audio, target, 1.0)
+    logger.info(f"[LONG] {duration:.0f} с → {len(spans)} кусков")
+    results: list = [None] * len(spans)
+
+    async def run(i: int, start: int, end: int):
+        results[i] = await run_inference(
+            _transcribe_chunk, audio[start:end], model_name, options
+        )
+        if on_text is not None:
+            # Показываем только непрерывное начало — куски завершаются вразнобой
+            done = list(itertools.takewhile(lambda x: x is not None, results))
+            if done:
+                on_text(stitch_chunks([text for text, *_ in done]))
+
+    await asyncio.gather(*(run(i, a, b) for i, (a, b) in enumerate(spans)))
+
+    text = stitch_chunks([text for text, *_ in results])
+    languages = [language for _, language, *_ in results if language]
+    logprobs = [lp for *_, chunk_logprobs in results for lp in chunk_logprobs]
+    return Transcript(
+        text,
+        max(set(languages), key=languages.count) if languages else None,
+        sum(prob for _, _, prob, *_ in results) / len(results),
+        sum(logprobs) / len(logprobs) if logprobs else None,
+        sum(seconds for *_, seconds, _ in results),
+    )
+
+
+async def transcribe(audio, model_name=None, options=None, on_partial=None):
+    """Текст без пунктуации — её расставляет отдельный этап, punctuate.
+
+    on_partial — корутинная функция, получает промежуточный текст.
+    """
+    options = options or WHISPER_OPTIONS
+    long_audio = (
+        LONG_AUDIO_SECONDS > 0
+        and isinstance(audio, np.ndarray)
+        and len(audio) >= LONG_AUDIO_SECONDS * SAMPLE_RATE
+    )
+    # В батч — только клипы до 30 с: длинный держал бы ответы на короткие из того
+    # же батча до конца своего распознавания и остался бы без промежуточного текста
+    batched = (
+        batcher is not None
+        and not long_audio
+        and isinstance(audio, np.ndarray)
+        and len(audio) <= 30 * SAMPLE_RATE
+    )
+
+    async def run(on_text):
+        try:
+            if long_audio:
+                return await transcribe_long(audio, model_name, options, on_text)
+            if batched:
+                return await batcher.transcribe(audio, model_name, options)
+            return await run_inference(
+                transcribe_file_sync, audio, model_name, options, on_text=on_text
+            )
+        except BrokenProcessPool as e:
+            logger.error(f"[WORKERS] голосовое потеряно вместе с исполнителем: {e}")
+            return Transcript("Ошибка: процесс распознавания аварийно завершился")
+
+    if on_partial is None or STREAM_INTERVAL <= 0 or batched:
+        return await run(None)
+    partial = PartialTranscript(on_partial, STREAM_INTERVAL)
+    ticker = asyncio.create_task(partial.run())
+    try:
+        return await run(partial.push)
+    finally:
+        # Дожидаемся текущего edit, чтобы он не лёг поверх финального текста
+        partial.stop()
+        await ticker
+
+
+# ==================== Адаптивное качество ====================
+# Когда очередь растёт, лучше чуть хуже, но сразу. Ступень 0 — настройки как есть,
+# дальше меньше beam_size и температурных перезапусков, на последней — ещё и
+# резидентная модель поменьше (из маршрутизации или DEGRADE_MODEL)
+QUALITY_LEVELS = [
+    {},
+    dict(beam_size=2, temperature=[0.0, 0.4, 0.8]),
+    dict(beam_size=1, temperature=[0.0]),
+    dict(beam_size=1, temperature=[0.0]),
+]
+
+
+class LoadGovernor:
+    """Выбирает ступень качества по длине очереди и недавнему RTF."""
+
+    def __init__(self, queue_limit: int, rtf_limit: float, cooldown: float = 10):
+        self.queue_limit = queue_limit
+        self.rtf_limit = rtf_limit
+        self.cooldown = cooldown
+        self.level = 0
+        self.rtf = None
+        self._changed = 0.0
+
+    def record(self, audio_seconds, seconds: float):
+        """seconds — время инференса: ожидание в очереди уже учтено её длиной."""
+        if not audio_seconds or not seconds:
+            return
+        rtf = seconds / audio_seconds
+        self.rtf = rtf if self.rtf is None else 0.7 * self.rtf + 0.3 * rtf
+
+    @staticmethod
+    def depth() -> int:
+        return scheduler.pending + transcribe_stage.waiting
+
+    def update(self, queue_depth: int):
+        """Вызывается и с приходом голосового, и по завершении каждой задачи."""
+        if not self.queue_limit:
+            return
+        # Очередь разобрана — качество возвращается сразу, без cooldown
+        if not queue_depth:
+            if self.level > 0:
+                self.level = 0
+                self._changed = time.monotonic()
+                logger.info("[QUALITY] очередь пуста → ступень 0")
+            return
+        # Вверх не чаще раза в cooldown секунд — иначе пачка голосовых проскочит
+        # все ступени
+        if time.monotonic() - self._changed < self.cooldown:
+            return
+        slow = self.rtf is not None and self.rtf > self.rtf_limit
+        if queue_depth >= self.queue_limit or slow:
+            if self.level < len(QUALITY_LEVELS) - 1:
+                self.level += 1
+                self._changed = time.monotonic()
+                logger.info(f"[QUALITY] очередь {queue_depth} → ступень {self.level}")
+
+    def apply(self, model_name: str) -> tuple:
+        """(имя модели, настройки) с учётом текущей ступени."""
+        self.update(self.depth())
+        options = {**WHISPER_OPTIONS, **QUALITY_LEVELS[self.level]}
+        if self.level == len(QUALITY_LEVELS) - 1:
+            smaller = [
+                name
+                for name in route_models
+                if AVAILABLE_MODELS.index(name) < AVAILABLE_MODELS.index(model_name)
+            ]
+            if smaller:
+                return max(smaller, key=AVAILABLE_MODELS.index), options
+        return model_name, options
+
+    def stats(self) -> str:
+        rtf = f"{self.rtf:.2f}" if self.rtf is not None else "—"
+        beam = QUALITY_LEVELS[self.level].get("beam_size", WHISPER_OPTIONS["beam_size"])
+        return (
+            f"ступень {self.level}/{len(QUALITY_LEVELS) - 1} (beam {beam}), RTF {rtf}"
+        )
+
+
+governor = LoadGovernor(DEGRADE_QUEUE, DEGRADE_RTF)
+
+
+# ==================== Языковые профили ====================
+class LanguageProfiles:
+    """Язык собеседника (пользователя или чата), выученный по результатам детекции.
+
+    Пока профиль не уверен, язык определяется на каждом голосовом. Когда один язык
+    набирает достаточный вес — он передаётся в model.transcribe напрямую, без прохода
+    детекции. Если на нём распознаётся плохо (низкий avg_logprob), вес уходит в «?»,
+    уверенность падает и детекция включается снова. Веса затухают — профиль следует
+    за последними голосовыми.
+    """
+
+    DECAY = 0.85
+    MIN_WEIGHT = 2.5
+    CONFIDENCE = 0.8
+    MIN_LOGPROB = -1.0
+
+    @staticmethod
+    def key(speaker: int) -> str:
+        return f"lang:{speaker}"
+
+    def language_for(self, speaker: int) -> Optional[str]:
+        weights = {k: float(v) for k, v in r.hgetall(self.key(speaker)).items()}
+        total = sum(weights.values())
+        if total < self.MIN_WEIGHT:
+            return None
+        language, weight = max(weights.items(), key=lambda kv: kv[1])
+        if language == "?" or weight / total < self.CONFIDENCE:
+            return None
+        return language
+
+    def observe(self, speaker: int, result: Transcript, forced: bool):
+        if transcription_failed(result.text) or not result.language:
+            return
+        weights = {
+            k: float(v) * self.DECAY for k, v in r.hgetall(self.key(speaker)).items()
+        }
+        if not forced:
+            label, weight = result.language, result.language_probability
+        elif result.avg_logprob is not None and result.avg_logprob < self.MIN_LOGPROB:
+            label, weight = "?", 1.0
+            logger.info(f"[LANG] {speaker}: {result.language} распознаётся плохо")
+        else:
+            label, weight = result.language, 1.0
+        weights[label] = weights.get(label, 0.0) + weight
+        pipe = r.pipeline()
+        pipe.delete(self.key(speaker))
+        pipe.hset(
+            self.key(speaker), mapping={k: f"{v:.3f}" for k, v in weights.items()}
+        )
+        pipe.execute()
+
+    def stats(self) -> str:
+        confident = sum(
+            1
+            for key in r.scan_iter("lang:*")
+            if self.language_for(int(key.split(":", 1)[1])) is not None
+        )
+        return f"уверенных профилей: {confident}"
+
+
+language_profiles = LanguageProfiles()
+
+
+# ==================== Кэш транскриптов ====================
+class TranscriptCache:
+    """Готовые тексты в Redis по file_unique_id + модель + настройки декодирования.
+
+    Пересланная копия голосового имеет тот же file_unique_id — её не нужно ни
+    скачивать, ни распознавать. Вытеснение — по TTL и по LRU при превышении объёма.
+    """
+
+    LRU = "tcache:lru"
+    SIZES = "tcache:sizes"
+    BYTES = "tcache:bytes"
+
+    def __init__(self, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Счётчик объёма ведётся при put; пересчёт целиком — только если его нет
+        if not r.exists(self.BYTES):
+            r.setnx(self.BYTES, sum(int(v) for v in r.hvals(self.SIZES)))
+
+    @staticmethod
+    def settings(model_name: str, options: dict) -> str:
+        """Модель и хэш настроек декодирования — часть ключей кэша и отпечатков."""
+        digest = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+        return f"{model_name}:{digest.hexdigest()[:8]}"
+
+    @classmethod
+    def key(cls, file_unique_id: str, model_name: str, options: dict) -> str:
+        return f"tcache:{cls.settings(model_name, options)}:{file_unique_id}"
+
+    def get(self, file_unique_id: str, model_name: str, options: dict):
+        key = self.key(file_unique_id, model_name, options)
+        text = r.get(key)
+        if text is None:
+            r.incr("tcache:misses")
+            return None
+        pipe = r.pipeline()
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.LRU, {key: time.time()})
+        pipe.incr("tcache:hits")
+        pipe.execute()
+        return text
+
+    def put(self, file_unique_id: str, model_name: str, options: dict, text: str):
+        if transcription_failed(text):
+            return
+        key = self.key(file_unique_id, model_name, options)
+        size = len(text.encode())
+        old = int(r.hget(self.SIZES, key) or 0)
+        pipe = r.pipeline()
+        pipe.set(key, text, ex=self.ttl)
+        pipe.zadd(self.LRU, {key: time.time()})
+        pipe.hset(self.SIZES, key, size)
+        pipe.incrby(self.BYTES, size - old)
+        pipe.execute()
+        self._evict()
+
+    def _drop(self, keys: list):
+        sizes = r.hmget(self.SIZES, keys)
+        pipe = r.pipeline()
+        pipe.delete(*keys)
+        pipe.zrem(self.LRU, *keys)
+        pipe.hdel(self.SIZES, *keys)
+        pipe.decrby(self.BYTES, sum(int(size or 0) for size in sizes))
+        pipe.execute()
+
+    def _evict(self):
+        # Ключи, к которым не обращались дольше TTL, Redis уже удалил — чистим индекс
+        expired = r.zrangebyscore(
+            self.LRU, "-inf", time.time() - self.ttl, start=0, num=100
+        )
+        if expired:
+            self._drop(expired)
+        # Сверх объёма — снимаем с головы LRU по одному
+        while int(r.get(self.BYTES) or 0) > self.max_bytes:
+            oldest = r.zpopmin(self.LRU)
+            if not oldest:
+                r.set(self.BYTES, 0)
+                break
+            self._drop([oldest[0][0]])
+
+    def stats(self) -> str:
+        return (
+            f"{r.get('tcache:hits') or 0} попаданий / "
+            f"{r.get('tcache:misses') or 0} промахов, "
+            f"{r.zcard(self.LRU)} записей"
+        )
+
+
+transcript_cache = TranscriptCache(CACHE_MAX_BYTES, CACHE_TTL)
+
+
+# ==================== Акустические отпечатки ====================
+# Повторная загрузка того же аудио получает новый file_unique_id. Ловим её по
+# отпечатку PCM (схема Haitsma–Kalker): 32 бита на кадр — знаки разностей энергий
+# соседних частотных полос во времени. Пережатие Opus меняет лишь малую долю бит.
+FP_FRAME = 2048
+FP_HOP = 512
+FP_MAX_SHIFT = 8
+_fp_freqs = np.fft.rfftfreq(FP_FRAME, 1 / SAMPLE_RATE)
+_fp_edges = np.geomspace(300, 2000, 34)
+FP_BANDS = (
+    (_fp_freqs[None, :] >= _fp_edges[:-1, None])
+    & (_fp_freqs[None, :] < _fp_edges[1:, None])
+).astype(np.float32)
+FP_WINDOW = np.hanning(FP_FRAME).astype(np.float32)
+
+
+def audio_fingerprint(audio: np.ndarray) -> np.ndarray:
+    """Отпечаток: массив uint32, по одному значению на кадр (шаг 32 мс)."""
+    if len(audio) < FP_FRAME + 2 * FP_HOP:
+        return np.zeros(0, dtype="<u4")
+    frames = np.lib.stride_tricks.sliding_window_view(audio, FP_FRAME)[::FP_HOP]
+    spectrum = np.abs(np.fft.rfft(frames * FP_WINDOW, axis=1)) ** 2
+    energy = spectrum @ FP_BANDS.T
+    band_diff = np.diff(energy, axis=1)
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    return np.packbits(bits, axis=1, bitorder="little").view("<u4").ravel()
+
+
+def bit_error_rate(a: np.ndarray, b: np.ndarray) -> float:
+    """Наименьшая доля различающихся бит с учётом сдвига до FP_MAX_SHIFT кадров."""
+    best = 1.0
+    for shift in range(-FP_MAX_SHIFT, FP_MAX_SHIFT + 1):
+        x, y = (a[shift:], b) if shift >= 0 else (a, b[-shift:])
+        n = min(len(x), len(y))
+        if n < len(a) // 2:
+            continue
+        diff = np.bitwise_xor(x[:n], y[:n]).view(np.uint8)
+        best = min(best, np.unpackbits(diff).sum() / (n * 32))
+    return best
+
+
+def decode_and_fingerprint(source):
+    started = time.monotonic()
+    audio = load_audio(source)
+    if fingerprint_index is None:
+        return audio, None, 0.0
+    return audio, audio_fingerprint(audio), time.monotonic() - started
+
+
+class FingerprintIndex:
+    """Отпечатки с текстами в Redis и обратный индекс «значение кадра → file_unique_id».
+
+    Записи живут в LRU по времени добавления: старше TTL и сверх max_entries
+    снимаются вместе со своими членами индекса, иначе множества индекса только
+    росли бы и поиск дорожал бы со всей историей.
+    """
+
+    INDEXED_FRAMES = 256
+    LRU = "fp:lru"
+
+    def __init__(self, max_ber: float, ttl: int, max_entries: int):
+        self.max_ber = max_ber
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @staticmethod
+    def index_keys(codes: np.ndarray) -> set:
+        # Индексируем половины кадра по 16 бит: целый 32-битный кадр после
+        # пережатия совпадает точно слишком редко, а половина — часто
+        codes = codes[codes != 0]
+        return {f"fp:idx:h{c}" for c in np.unique(codes >> 16)} | {
+            f"fp:idx:l{c}" for c in np.unique(codes & 0xFFFF)
+        }
+
+    def lookup(self, fingerprint: np.ndarray, model_name: str, options: dict):
+        """Возвращает (text, секунды распознавания оригинала) или None.
+
+        Годятся только записи с той же моделью и теми же настройками декодирования.
+        """
+        if np.count_nonzero(fingerprint) < 8:
+            return None
+        settings = TranscriptCache.settings(model_name, options) + ":"
+        pipe = r.pipeline()
+        for key in self.index_keys(fingerprint):
+            pipe.smembers(key)
+        votes: dict = {}
+        for members in pipe.execute():
+            for member in members:
+                if member.startswith(settings):
+                    votes[member] = votes.get(member, 0) + 1
+        for candidate, count in sorted(votes.items(), key=lambda kv: -kv[1])[:3]:
+            if count < 4:
+                break
+            entry = r.hgetall(f"fp:{candidate}")
+            if not entry:
+                continue
+            stored = np.frombuffer(bytes.fromhex(entry["fp"]), dtype="<u4")
+            if bit_error_rate(fingerprint, stored) <= self.max_ber:
+                return entry["text"], float(entry.get("seconds") or 0)
+        return None
+
+    def add(
+        self,
+        file_unique_id,
+        model_name,
+        options: dict,
+        fingerprint: np.ndarray,
+        text,
+        seconds,
+    ):
+        if transcription_failed(text) or np.count_nonzero(fingerprint) < 8:
+            return
+        member = f"{TranscriptCache.settings(model_name, options)}:{file_unique_id}"
+        step = max(1, len(fingerprint) // self.INDEXED_FRAMES)
+        index_keys = self.index_keys(fingerprint[::step])
+        pipe = r.pipeline()
+        # Без TTL у записи: по списку её ключей индекса её снимает _evict
+        pipe.hset(
+            f"fp:{member}",
+            mapping={
+                "fp": fingerprint.tobytes().hex(),
+                "text": text,
+                "seconds": f"{seconds:.2f}",
+                "model": model_name,
+                "index": " ".join(index_keys),
+            },
+        )
+        pipe.zadd(self.LRU, {member: time.time()})
+        for index_key in index_keys:
+            pipe.sadd(index_key, member)
+            pipe.expire(index_key, self.ttl)
+        pipe.execute()
+        self._evict()
+
+    def _drop(self, members: list):
+        pipe = r.pipeline()
+        for member in members:
+            pipe.hget(f"fp:{member}", "index")
+        index = pipe.execute()
+        pipe = r.pipeline()
+        for member, index_keys in zip(members, index):
+            for index_key in (index_keys or "").split():
+                pipe.srem(index_key, member)
+            pipe.delete(f"fp:{member}")
+        pipe.zrem(self.LRU, *members)
+        pipe.execute()
+
+    def _evict(self):
+        expired = r.zrangebyscore(
+            self.LRU, "-inf", time.time() - self.ttl, start=0, num=100
+        )
+        if expired:
+            self._drop(expired)
+        excess = r.zcard(self.LRU) - self.max_entries
+        if excess > 0:
+            self._drop([member for member, _ in r.zpopmin(self.LRU, excess)])
+
+    def record_saving(self, seconds: float):
+        pipe = r.pipeline()
+        pipe.incr("fp:hits")
+        pipe.incrbyfloat("fp:saved_seconds", max(0.0, seconds))
+        pipe.execute()
+
+    def stats(self) -> str:
+        saved = float(r.get("fp:saved_seconds") or 0)
+        return (
+            f"{r.get('fp:hits') or 0} повторов, сэкономлено {saved:.0f} с, "
+            f"{r.zcard(self.LRU)} отпечатков"
+        )
+
+
+fingerprint_index = (
+    FingerprintIndex(FINGERPRINT_BER, CACHE_TTL, FINGERPRINT_MAX)
+    if FINGERPRINT_BER > 0
+    else None
+)
+
+
+class RecentAudio:
+    """Недавно декодированные голосовые (PCM + язык) в памяти, LRU по объёму."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+
+    def put(self, file_unique_id: str, audio: np.ndarray, language):
+        if audio.nbytes > self.max_bytes:
+            return
+        old = self._items.pop(file_unique_id, None)
+        if old is not None:
+            self._bytes -= old[0].nbytes
+        self._items[file_unique_id] = (audio, language)
+        self._bytes += audio.nbytes
+        while self._bytes > self.max_bytes:
+            _, (evicted, _) = self._items.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def get(self, file_unique_id: str):
+        item = self._items.get(file_unique_id)
+        if item is not None:
+            self._items.move_to_end(file_unique_id)
+        return item
+
+
+recent_audio = RecentAudio(RECENT_AUDIO_BYTES)
+
+
+# ==================== Кэш аудио на диске ====================
+class AudioCache:
+    """Скачанный ogg и декодированный PCM на диске по file_unique_id, LRU по объёму.
+
+    PCM хранится в .npy и открывается через mmap: повторный прогон (/retranscribe)
+    не скачивает и не декодирует, а страницы читаются с диска по мере надобности.
+    Порядок LRU — по mtime файлов, поэтому переживает перезапуск.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                # Недописанный при падении файл
+                os.remove(path)
+            elif name.endswith(".npy"):
+                pcm = os.stat(path)
+                try:
+                    ogg = os.stat(path[:-4] + ".ogg")
+                except FileNotFoundError:
+                    os.remove(path)
+                    continue
+                entries.append((pcm.st_mtime, name[:-4], pcm.st_size + ogg.st_size))
+        for _, file_unique_id, size in sorted(entries):
+            self._items[file_unique_id] = size
+            self._bytes += size
+
+    def _path(self, file_unique_id: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{file_unique_id}.{ext}")
+
+    def get(self, file_unique_id: str):
+        """(ogg, PCM в mmap) или None."""
+        with self._lock:
+            if file_unique_id not in self._items:
+                self.misses += 1
+                return None
+            self._items.move_to_end(file_unique_id)
+            self.hits += 1
+        pcm_path = self._path(file_unique_id, "npy")
+        try:
+            with open(self._path(file_unique_id, "ogg"), "rb") as f:
+                payload = f.read()
+            # Копирование при записи: правки массива не попадут в файл
+            audio = np.load(pcm_path, mmap_mode="c")
+            os.utime(pcm_path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[AUDIO_CACHE] {file_unique_id}: {e}")
+            self._drop(file_unique_id)
+            return None
+        return payload, audio
+
+    def put(self, file_unique_id: str, payload: bytes, audio: np.ndarray):
+        try:
+            size = len(payload) + audio.nbytes
+            if size > self.max_bytes:
+                return
+            # Сначала .ogg: при старте .npy без пары считается мусором
+            for ext, write in (
+                ("ogg", lambda f: f.write(payload)),
+                ("npy", lambda f: np.save(f, audio.astype(np.float32, copy=False))),
+            ):
+                path = self._path(file_unique_id, ext)
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    write(f)
+                os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"[AUDIO_CACHE] запись {file_unique_id}: {e}")
+            return
+        with self._lock:
+            self._bytes += size - self._items.pop(file_unique_id, 0)
+            self._items[file_unique_id] = size
+            victims = []
+            while self._bytes > self.max_bytes:
+                victim, victim_size = self._items.popitem(last=False)
+                self._bytes -= victim_size
+                victims.append(victim)
+        for victim in victims:
+            self._remove_files(victim)
+
+    def _drop(self, file_unique_id: str):
+        with self._lock:
+            self._bytes -= self._items.pop(file_unique_id, 0)
+        self._remove_files(file_unique_id)
+
+    def _remove_files(self, file_unique_id: str):
+        for ext in ("npy", "ogg"):
+            try:
+                os.remove(self._path(file_unique_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> str:
+        return (
+            f"{len(self._items)} голосовых, {self._bytes / 2**20:.0f} из "
+            f"{self.max_bytes / 2**20:.0f} МБ, {self.hits} попаданий / "
+            f"{self.misses} промахов"
+        )
+
+
+audio_cache = (
+    AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_BYTES)
+    if AUDIO_CACHE_BYTES > 0 and not WORKER_MODE
+    else None
+)
+
+
+# ==================== Воркеры (Redis Streams) ====================
+# Бот с REMOTE_WORKERS кладёт голосовые (ogg как есть) в поток voice:jobs, воркеры
+# (`--worker`, хоть на других машинах) читают его группой потребителей и отвечают
+# в voice:results. Задание подтверждается (XACK) только после ответа; зависшее у
+# упавшего воркера дольше JOB_TIMEOUT забирает другой (XAUTOCLAIM). Пока задание
+# в работе, воркер продлевает его, так что длинные голосовые не уходят дважды.
+JOB_STREAM = "voice:jobs"
+RESULT_STREAM = "voice:results"
+JOB_GROUP = "workers"
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT") or "120")
+JOB_MAX_DELIVERIES = int(os.getenv("JOB_MAX_DELIVERIES") or "3")
+# Сколько голосовых бот держит у воркеров одновременно — остальные ждут в
+# приоритетной очереди бота, чтобы свои голосовые обгоняли фоновые
+REMOTE_INFLIGHT = int(os.getenv("REMOTE_INFLIGHT") or "8")
+
+
+def stream_redis() -> redis.Redis:
+    # Аудио в потоке — бинарное, без decode_responses
+    return redis.Redis(host=REDIS_HOST, port=6379, db=0)
+
+
+class JobQueue:
+    """Сторона бота: отправка заданий и ожидание ответов воркеров."""
+
+    def __init__(self):
+        self.redis = stream_redis()
+        # id задания → (loop, future, push промежуточного текста)
+        self._waiting: dict = {}
+        self._listener = None
+
+    def _listen(self, last: str):
+        while True:
+            try:
+                streams = self.redis.xread({RESULT_STREAM: last}, count=100, block=5000)
+            except redis.RedisError as e:
+                logger.warning(f"[JOBS] чтение ответов: {e}")
+                time.sleep(1)
+                continue
+            for _, entries in streams or []:
+                for entry_id, fields in entries:
+                    last = entry_id
+                    waiting = self._waiting.get(fields[b"id"].decode())
+                    if waiting is None:
+                        continue
+                    loop, future, push = waiting
+                    if fields[b"type"] == b"partial":
+                        if push is not None:
+                            push(fields[b"text"].decode())
+                    else:
+                        reply = json.loads(fields[b"result"])
+                        loop.call_soon_threadsafe(self._resolve, future, reply)
+
+    @staticmethod
+    def _resolve(future, reply: dict):
+        if future.done():
+            return
+        if "error" in reply:
+            future.set_exception(RuntimeError(reply["error"]))
+        else:
+            future.set_result(reply["ok"])
+
+    async def submit(self, kind: str, audio: bytes, on_partial=None, **params):
+        if self._listener is None:
+            # Ответы читаем с текущего конца потока — до первого задания
+            last = self.redis.xrevrange(RESULT_STREAM, count=1)
+            self._listener = threading.Thread(
+                target=self._listen, args=(last[0][0] if last else "0-0",), daemon=True
+            )
+            self._listener.start()
+        loop = asyncio.get_running_loop()
+        job_id = uuid.uuid4().hex
+        future = loop.create_future()
+        partial = None
+        if on_partial is not None and STREAM_INTERVAL > 0:
+            partial = PartialTranscript(on_partial, STREAM_INTERVAL)
+            params["stream"] = True
+        self._waiting[job_id] = (loop, future, partial.push if partial else None)
+        ticker = asyncio.create_task(partial.run()) if partial else None
+        try:
+            entry_id = self.redis.xadd(
+                JOB_STREAM,
+                {
+                    "id": job_id,
+                    "kind": kind,
+                    "params": json.dumps(params),
+                    "audio": audio,
+                },
+            )
+            return await self._wait(future, entry_id)
+        except asyncio.CancelledError:
+            # Ещё не взятое задание снимаем с потока, чтобы воркер не тратил на него слот
+            self.redis.xdel(JOB_STREAM, entry_id)
+            raise
+        finally:
+            self._waiting.pop(job_id, None)
+            if partial is not None:
+                partial.stop()
+                await ticker
+
+    def _in_progress(self, entry_id) -> bool:
+        # Живой воркер продлевает задание чаще, чем раз в JOB_TIMEOUT
+        pending = self.redis.xpending_range(
+            JOB_STREAM, JOB_GROUP, entry_id, entry_id, 1
+        )
+        return bool(pending) and pending[0]["time_since_delivered"] < JOB_TIMEOUT * 1000
+
+    async def _wait(self, future, entry_id):
+        """Ответ воркера или ошибка, если задание не у живого воркера слишком долго.
+
+        Без срока голосовое при упавших воркерах навсегда занимало бы места
+        этапа распознавания и планировщика, а бот молча вставал бы.
+        """
+        deadline = JOB_TIMEOUT * JOB_MAX_DELIVERIES
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), deadline)
+            except asyncio.TimeoutError:
+                # Длинное голосовое у живого воркера — ждём дальше
+                if self._in_progress(entry_id):
+                    continue
+                self.redis.xdel(JOB_STREAM, entry_id)
+                raise RuntimeError(f"воркеры не ответили за {deadline} с") from None
+
+    async def transcribe(self, audio: bytes, model_name, options, on_partial=None):
+        value = await self.submit(
+            "transcribe", audio, on_partial, model=model_name, options=options
+        )
+        return Transcript(*value)
+
+    def stats(self) -> str:
+        try:
+            groups = self.redis.xinfo_groups(JOB_STREAM)
+            consumers = self.redis.xinfo_consumers(JOB_STREAM, JOB_GROUP)
+        except redis.ResponseError:
+            return "ещё не подключались"
+        group = next((g for g in groups if g["name"] == JOB_GROUP.encode()), {})
+        alive = sum(1 for c in consumers if c["idle"] < JOB_TIMEOUT * 1000)
+        return (
+            f"{alive} на связи, {group.get('pending', 0)} в работе, "
+            f"{group.get('lag') or 0} ждут"
+        )
 
-try:
-    _c = sqlite3.connect(SESSION_FILE)
-    _c.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    _c.close()
-    logger.info(f"Session валиден ({os.path.getsize(SESSION_FILE)} байт)")
-except Exception as _e:
-    logger.critical(f"❌ Session повреждён: {_e}")
-    sys.exit(1)
 
-# ==================== Клиент ====================
-# Синхронный паттерн как в старом рабочем боте + workdir для Docker
-app = Client(
-    SESSION_NAME,
-    api_id=API_ID,
-    api_hash=API_HASH,
-    workdir=SESSION_WORKDIR,
-)
+job_queue = JobQueue() if REMOTE else None
 
-# ==================== Модели ====================
-model = None
-punct_model = None
-CPU_CORES = multiprocessing.cpu_count()
-executor = ThreadPoolExecutor(max_workers=CPU_CORES)
-AVAILABLE_MODELS = ["tiny", "base", "small", "medium", "large-v2", "large-v3"]
 
-# Хранилище фоновых задач — предотвращает GC asyncio tasks (Python docs)
-_background_tasks: set = set()
+class StreamWorker:
+    """Сторона воркера: задания из группы потребителей → transcribe → ответ."""
 
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.redis = stream_redis()
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        # Записи потока в работе — их простой продлевается
+        self._active: set = set()
+        self._models = None
+        self._reloading = False
 
-def get_tracked_users():
-    try:
-        users_json = r.get("tracked_users")
-        return json.loads(users_json) if users_json else []
-    except Exception:
-        return []
+    def _ensure_group(self):
+        try:
+            self.redis.xgroup_create(JOB_STREAM, JOB_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _next(self):
+        """Следующее задание: сначала брошенное упавшим воркером, потом новое."""
+        _, claimed, *_ = self.redis.xautoclaim(
+            JOB_STREAM, JOB_GROUP, self.name, JOB_TIMEOUT * 1000, "0-0", count=1
+        )
+        for entry_id, fields in claimed:
+            if not fields:
+                continue
+            pending = self.redis.xpending_range(
+                JOB_STREAM, JOB_GROUP, entry_id, entry_id, 1
+            )
+            deliveries = pending[0]["times_delivered"] if pending else 1
+            if deliveries > JOB_MAX_DELIVERIES:
+                # Задание, роняющее воркеров, — не передаём дальше по кругу
+                logger.error(f"[WORKER] {entry_id} выдано {deliveries} раз, отбрасываю")
+                self._reply(fields, {"error": "задание несколько раз роняло воркеры"})
+                self._ack(entry_id)
+                continue
+            logger.warning(f"[WORKER] подобрал зависшее задание {entry_id}")
+            return entry_id, fields
+        streams = self.redis.xreadgroup(
+            JOB_GROUP, self.name, {JOB_STREAM: ">"}, count=1, block=5000
+        )
+        for _, entries in streams or []:
+            for entry_id, fields in entries:
+                return entry_id, fields
+        return None
+
+    def _reply(self, fields: dict, reply: dict):
+        self.redis.xadd(
+            RESULT_STREAM,
+            {"id": fields[b"id"], "type": "done", "result": json.dumps(reply)},
+            maxlen=10000,
+            approximate=True,
+        )
 
+    def _ack(self, entry_id):
+        self.redis.xack(JOB_STREAM, JOB_GROUP, entry_id)
+        self.redis.xdel(JOB_STREAM, entry_id)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_TIMEOUT / 3)
+            if self._active:
+                # XCLAIM на себя сбрасывает простой, JUSTID — без счётчика выдач
+                self.redis.xclaim(
+                    JOB_STREAM,
+                    JOB_GROUP,
+                    self.name,
+                    0,
+                    list(self._active),
+                    justid=True,
+                )
 
-def add_tracked_user(user_id: int):
-    users = get_tracked_users()
-    if user_id not in users:
-        users.append(user_id)
-        r.set("tracked_users", json.dumps(users))
-        return True
-    return False
+    def _sync_models(self):
+        """Подхватывает смену модели и маршрутов, сделанную ботом через /model.
 
+        Загрузка идёт в фоне: пока она длится, задания обслуживает старая модель.
+        """
+        models = (r.get("model") or MODEL_SIZE, get_routes())
+        if models == self._models or self._reloading:
+            return
+        if self._models is None:
+            self._models = models
+            return
+        main = models[0] if models[0] != self._models[0] else None
+        logger.info(f"[WORKER] смена моделей: {models}")
+        self._reloading = True
 
-def remove_tracked_user(user_id: int):
-    users = get_tracked_users()
-    if user_id in users:
-        users.remove(user_id)
-        r.set("tracked_users", json.dumps(users))
-        return True
-    return False
+        def reload():
+            try:
+                reload_models(main)
+            except Exception as e:
+                logger.error(f"[WORKER] не удалось сменить модели: {e}")
+            finally:
+                self._models = models
+                self._reloading = False
 
+        threading.Thread(target=reload, daemon=True).start()
 
-def load_model(model_size: str):
-    global model
-    if model is not None:
-        del model
-        gc.collect()
-    model = WhisperModel(
-        model_size,
-        device="cpu",
-        compute_type="int8",
-        cpu_threads=CPU_CORES,
-        num_workers=1,
-    )
-    r.set("model", model_size)
-    logger.info(f"Модель {model_size} загружена ({CPU_CORES} потоков)")
+    async def _handle(self, entry_id, fields: dict):
+        job_id = fields[b"id"].decode()
+        params = json.loads(fields[b"params"])
+        self._active.add(entry_id)
+        try:
+            audio = await decode_stage.run(load_audio, fields[b"audio"])
+            if fields[b"kind"] == b"timestamps":
+                value = await run_inference(
+                    word_timestamps_sync, audio, params["model"], params["language"]
+                )
+            else:
 
+                async def on_partial(text: str):
+                    self.redis.xadd(
+                        RESULT_STREAM,
+                        {"id": job_id, "type": "partial", "text": text},
+                        maxlen=10000,
+                        approximate=True,
+                    )
 
-def load_punctuation_model():
-    global punct_model
-    logger.info("Загружаю модель пунктуации...")
-    punct_model = PunctuationModel(model="kredor/punctuate-all")
-    logger.info("Модель пунктуации загружена")
+                result = await transcribe(
+                    audio,
+                    params["model"],
+                    params["options"],
+                    on_partial if params.get("stream") else None,
+                )
+                value = list(await punctuate(result))
+            reply = {"ok": value}
+        except Exception as e:
+            logger.error(f"[WORKER] задание {job_id}: {e}", exc_info=True)
+            reply = {"error": str(e)}
+        finally:
+            self._active.discard(entry_id)
+        self._reply(fields, reply)
+        self._ack(entry_id)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._ensure_group()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        logger.info(f"[WORKER] {self.name}: до {self.concurrency} заданий сразу")
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks: set = set()
+        while True:
+            await slots.acquire()
+            try:
+                await loop.run_in_executor(None, self._sync_models)
+                job = await loop.run_in_executor(None, self._next)
+            except redis.RedisError as e:
+                logger.warning(f"[WORKER] Redis: {e}")
+                job = None
+                await asyncio.sleep(1)
+            if job is None:
+                slots.release()
+                continue
+            task = asyncio.create_task(self._handle(*job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+
+# ==================== Конвейер ====================
+# Голосовое проходит этапы: скачивание → декодирование → распознавание →
+# пунктуация → отправка. У каждого этапа свой лимит одновременных задач и свой
+# пул потоков для CPU-работы: медленное скачивание не занимает слот Whisper, а
+# пунктуация не делит с ним executor. Очереди между этапами ограничены числом
+# голосовых, которые пускает планировщик (места распознавания + PIPELINE_PREFETCH).
+# Приоритет задачи планировщика, в которой идёт голосовое: свободное место этапа
+# достаётся ждущему с наименьшим приоритетом, иначе свои голосовые стояли бы на
+# каждом этапе за уже впущенными чужими и фоновыми
+job_priority: contextvars.ContextVar = contextvars.ContextVar("job_priority", default=0)
+
+
+class Stage:
+    """Этап конвейера: ограничение одновременных задач и счётчики для /status."""
+
+    def __init__(self, name: str, limit: int, pool=None):
+        self.name = name
+        self.limit = limit
+        self.pool = pool
+        self.active = 0
+        self._free = limit
+        # Куча (приоритет, порядок, future) — как очередь планировщика
+        self._waiters: list = []
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def _acquire(self):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (job_priority.get(), next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            else:
+                # Место уже передано этой задаче — отдаём следующей
+                self._release()
+            raise
+
+    def _release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
 
+    async def run(self, fn, *args, **kwargs):
+        """Корутинная fn — в event loop, обычная — в пуле потоков этапа."""
+        await self._acquire()
+        self.active += 1
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                return await fn(*args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, functools.partial(fn, *args, **kwargs)
+            )
+        finally:
+            self.active -= 1
+            self._release()
 
-load_model(r.get("model") or MODEL_SIZE)
-load_punctuation_model()
+    def stats(self) -> str:
+        text = f"{self.name} {self.active}/{self.limit}"
+        return text + (f" (+{self.waiting} ждут)" if self.waiting else "")
 
 
-# ==================== Форматирование ====================
-def format_text(text: str) -> str:
-    if not text or text == "…" or punct_model is None:
-        return text
+download_stage = Stage("скачивание", PIPELINE_DOWNLOADS)
+# PyAV отпускает GIL — декодирование идёт параллельно распознаванию
+decode_stage = Stage(
+    "декодирование", PIPELINE_DECODERS, ThreadPoolExecutor(PIPELINE_DECODERS)
+)
+# В батч-режиме в работе должно быть сразу несколько голосовых — иначе батчу не из чего собираться
+transcribe_stage = Stage(
+    "распознавание", REMOTE_INFLIGHT if REMOTE else TRANSCRIBE_SLOTS * BATCH_SIZE
+)
+punctuate_stage = Stage("пунктуация", 1, ThreadPoolExecutor(1))
+send_stage = Stage("отправка", 4)
+stages = [download_stage, decode_stage, transcribe_stage, punctuate_stage, send_stage]
+
+
+def stages_text() -> str:
+    return ", ".join(stage.stats() for stage in stages)
+
+
+async def punctuate(result: Transcript) -> Transcript:
+    if transcription_failed(result.text):
+        return result
+    if inference_pool is not None:
+        # torch в родителе не запускаем: его потоки OpenMP не переживут fork
+        # следующего пула, а исполнители прогревают пунктуацию у себя
+        text = await punctuate_stage.run(run_inference, finish_text, result.text)
+    else:
+        text = await punctuate_stage.run(finish_text, result.text)
+    return result._replace(text=text)
+
+
+async def download_voice(message: Message) -> bytes:
+    """Ogg голосового: сразу в память или, при AUDIO_IN_MEMORY=false, через temp/."""
+    if AUDIO_IN_MEMORY:
+        buffer = await message.download(in_memory=True)
+        return buffer.getvalue()
+    os.makedirs("temp", exist_ok=True)
+    # message.id уникален только в пределах чата
+    file_path = await message.download(
+        os.path.join("temp", f"{message.chat.id}_{message.id}.ogg")
+    )
     try:
-        formatted = punct_model.restore_punctuation(text)
-        sentences = re.split(r"(?<=[.!?])\s+", formatted)
-        paragraphs, current = [], []
-        for sentence in sentences:
-            current.append(sentence)
-            if len(current) >= 4:
-                paragraphs.append(" ".join(current))
-                current = []
-        if current:
-            paragraphs.append(" ".join(current))
-        return "\n\n".join(paragraphs)
-    except Exception as e:
-        logger.error(f"Ошибка форматирования: {e}")
-        return text
+        with open(file_path, "rb") as f:
+            return f.read()
+    finally:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
 
 
-# ==================== Транскрипция ====================
-def transcribe_file_sync(file_path: str) -> str:
-    if model is None:
-        return "Ошибка: модель не загружена"
+async def fetch_audio(message: Message) -> tuple:
+    """(ogg, PCM или None): из дискового кэша — без скачивания и декодирования."""
+    if audio_cache is not None:
+        cached = audio_cache.get(message.voice.file_unique_id)
+        if cached is not None:
+            return cached
+    return await download_stage.run(download_voice, message), None
+
+
+def voice_settings(message: Message, model_name=None, language=None) -> tuple:
+    """(модель, настройки декодирования, настройки для ключей кэша, учить ли профиль).
+
+    Язык из профиля отправителя — подсказка декодеру, но не часть ключей кэша и
+    отпечатков: одно и то же пересланное голосовое от разных людей — одна запись.
+    """
+    if model_name is None:
+        model_name, options = governor.apply(route_model(message.voice.duration))
+    else:
+        options = dict(WHISPER_OPTIONS)
+    speaker = message.from_user.id if message.from_user else message.chat.id
+    learning = language is None and options["language"] is None
+    if language is not None:
+        options = {**options, "language": None if language == "auto" else language}
+    cache_options = options
+    if learning:
+        options = {**options, "language": language_profiles.language_for(speaker)}
+    return model_name, options, cache_options, learning
+
+
+def cached_text(message: Message) -> Optional[str]:
+    """Готовый текст из кэша — проверяется до очереди, чтобы не ждать её."""
+    model_name, _, cache_options, _ = voice_settings(message)
+    text = transcript_cache.get(message.voice.file_unique_id, model_name, cache_options)
+    if text is not None:
+        logger.info(f"[CACHE] попадание msg={message.id}, мимо очереди")
+    return text
+
+
+async def transcribe_preview(payload: bytes, audio, options: dict, on_preview):
+    """Черновик от PREVIEW_MODEL: жадный поиск, мимо очереди этапа распознавания."""
+    options = {**options, "beam_size": 1, "temperature": [0.0]}
     try:
-        segments, _ = model.transcribe(
-            file_path,
-            language="ru",
-            beam_size=5,
-            vad_filter=True,
-            vad_parameters=dict(min_silence_duration_ms=500, speech_pad_ms=400),
-            word_timestamps=True,
-        )
-        text = " ".join(seg.text for seg in segments).strip()
-        return format_text(text) if text and text != "…" else (text or "…")
+        if job_queue is not None:
+            result = await job_queue.transcribe(payload, PREVIEW_MODEL, options)
+        else:
+            result = await run_inference(
+                transcribe_file_sync,
+                audio,
+                PREVIEW_MODEL,
+                options,
+                pool=preview_executor,
+            )
+        if result.text and not transcription_failed(result.text):
+            await on_preview(result.text)
     except Exception as e:
-        logger.error(f"Ошибка транскрипции: {e}", exc_info=True)
-        return f"Ошибка: {e}"
+        logger.warning(f"[PREVIEW] {e}")
+
+
+async def voice_to_text(
+    message: Message, on_partial=None, model_name=None, language=None, on_preview=None
+) -> str:
+    """Текст голосового: из кэша, по отпечатку, иначе скачивание и транскрипция.
+
+    model_name и language (код или "auto") задаются явно из /retranscribe — тогда
+    без маршрутизации, ступеней качества и языкового профиля. on_preview —
+    корутинная функция для черновика от PREVIEW_MODEL, пока работает основная.
+    """
+    file_unique_id = message.voice.file_unique_id
+    # /retranscribe просит именно новый прогон — без кэша и отпечатков
+    explicit = model_name is not None or language is not None
+    model_name, options, cache_options, learning = voice_settings(
+        message, model_name, language
+    )
+    speaker = message.from_user.id if message.from_user else message.chat.id
+    if not explicit:
+        text = transcript_cache.get(file_unique_id, model_name, cache_options)
+        if text is not None:
+            logger.info(f"[CACHE] попадание msg={message.id}")
+            return text
+
+    # Исходный ogg держим в памяти: из него декодируется PCM, воркерам он уходит как есть
+    payload, cached = await fetch_audio(message)
+    audio, fingerprint, fp_seconds = cached, None, 0.0
+    # Воркерам уходит ogg, сами декодируют: PCM в боте нужен только для отпечатка
+    if job_queue is None or (fingerprint_index is not None and not explicit):
+        audio, fingerprint, fp_seconds = await decode_stage.run(
+            decode_and_fingerprint, payload if cached is None else cached
+        )
+    if audio_cache is not None and cached is None and audio is not None:
+        # Запись на диск — не на пути к ответу
+        asyncio.get_running_loop().run_in_executor(
+            None, audio_cache.put, file_unique_id, payload, audio
+        )
 
+    result = None
+    match = None
+    if fingerprint is not None and not explicit:
+        match = fingerprint_index.lookup(fingerprint, model_name, cache_options)
+    if match is not None:
+        text, seconds = match
+        fingerprint_index.record_saving(seconds - fp_seconds)
+        logger.info(
+            f"[FINGERPRINT] повтор msg={message.id}: "
+            f"{fp_seconds:.2f} с вместо {seconds:.2f} с"
+        )
+    else:
+        preview = None
+        if (
+            on_preview is not None
+            and PREVIEW_MODEL in resident_models()
+            and model_name != PREVIEW_MODEL
+        ):
+            preview = asyncio.create_task(
+                transcribe_preview(payload, audio, options, on_preview)
+            )
+            # Промежуточный текст основной модели отстаёт от черновика
+            on_partial = None
+            # Исполнители и воркеры берут задания по порядку — черновик ставим первым
+            await asyncio.sleep(0)
+        try:
+            if job_queue is not None:
+                # Воркер возвращает текст уже с пунктуацией
+                result = await transcribe_stage.run(
+                    job_queue.transcribe, payload, model_name, options, on_partial
+                )
+            else:
+                result = await punctuate(
+                    await transcribe_stage.run(
+                        transcribe, audio, model_name, options, on_partial
+                    )
+                )
+        finally:
+            # Опоздавший черновик не должен лечь поверх итогового текста
+            if preview is not None and not preview.done():
+                preview.cancel()
+        governor.record(message.voice.duration, result.seconds)
+        text = result.text
+        if fingerprint is not None:
+            # Экономия повтора — это время инференса оригинала, а не его ожидания
+            fingerprint_index.add(
+                file_unique_id,
+                model_name,
+                cache_options,
+                fingerprint,
+                text,
+                result.seconds,
+            )
 
-async def transcribe(file_path: str) -> str:
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(executor, transcribe_file_sync, file_path)
+    if learning and result is not None:
+        language_profiles.observe(speaker, result, options["language"] is not None)
+    # /timestamps у воркеров снова отправляет ogg — PCM в памяти бота им не нужен
+    if job_queue is None:
+        recent_audio.put(
+            file_unique_id, audio, result.language if result else options["language"]
+        )
+    transcript_cache.put(file_unique_id, model_name, cache_options, text)
+    return text
 
 
 def split_text(text: str, max_length: int = MESSAGE_LIMIT) -> list:
@@ -242,41 +2927,147 @@ def split_text(text: str, max_length: int = MESSAGE_LIMIT) -> list:
     return chunks
 
 
+# ==================== Планировщик ====================
+# Меньше — раньше: свои голосовые обгоняют чужие, чужие — фоновые задачи
+PRIORITY_MY = 0
+PRIORITY_TRACKED = 1
+PRIORITY_BACKGROUND = 2
+
+
+class JobScheduler:
+    """Очередь задач с приоритетами и ограничением числа одновременных задач."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = 0
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        # Ссылки на воркеры — чтобы asyncio tasks не собрал GC
+        self._workers: list = []
+
+    @property
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def place_for(self, priority: int) -> int:
+        """Место, которое займёт новая задача с таким приоритетом (0 — стартует сразу)."""
+        ahead = sum(1 for p, _, _ in self._heap if p <= priority)
+        return max(0, ahead + 1 - (self.slots - self.active))
+
+    def submit(self, priority: int, job) -> int:
+        """Ставит job (корутинную функцию без аргументов) в очередь, возвращает место."""
+        if not self._workers:
+            self._wakeup = asyncio.Event()
+            self._workers = [
+                asyncio.create_task(self._worker()) for _ in range(self.slots)
+            ]
+        place = self.place_for(priority)
+        heapq.heappush(self._heap, (priority, next(self._seq), job))
+        self._wakeup.set()
+        return place
+
+    async def _worker(self):
+        while not models_ready.is_set():
+            await asyncio.sleep(0.5)
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            priority, _, job = heapq.heappop(self._heap)
+            self.active += 1
+            job_priority.set(priority)
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"[SCHEDULER] задача упала: {e}", exc_info=True)
+            finally:
+                self.active -= 1
+                # Ступень качества пересматривается и когда очередь убывает
+                governor.update(governor.depth())
+
+
+# Сверх мест распознавания — голосовые, которые скачиваются и декодируются заранее
+scheduler = JobScheduler(transcribe_stage.limit + PIPELINE_PREFETCH)
+
+
+def queue_text(place: int) -> str:
+    if not models_ready.is_set():
+        return f"⏳ Модели загружаются, место в очереди {place + 1}..."
+    if place:
+        return f"⏳ В очереди, место {place}..."
+    return "⏳ Транскрипция в процессе..."
+
+
 # ==================== Обработка своих голосовых ====================
-async def process_my_voice(message: Message):
-    file_path = None
+def preview_caption(text: str) -> str:
+    head = "✏️ Черновик, уточняется…\n\n"
+    if len(head) + len(text) > CAPTION_LIMIT:
+        text = text[: CAPTION_LIMIT - len(head) - 1] + "…"
+    return head + text
+
+
+def record_latency(kind: str, seconds: float):
+    """Время от получения своего голосового до черновика (preview) и итога (final)."""
+    pipe = r.pipeline()
+    pipe.lpush(f"latency:{kind}", f"{seconds:.2f}")
+    pipe.ltrim(f"latency:{kind}", 0, 99)
+    pipe.execute()
+
+
+def latency_text() -> str:
+    parts = []
+    for kind, label in (("preview", "черновик"), ("final", "итог")):
+        values = sorted(float(v) for v in r.lrange(f"latency:{kind}", 0, -1))
+        if values:
+            parts.append(f"{label} {values[len(values) // 2]:.1f} с")
+    return ", ".join(parts) or "—"
+
+
+async def send_my_text(message: Message, text: str):
+    if len(text) <= CAPTION_LIMIT:
+        try:
+            await message.edit_caption(text)
+        except Exception as e:
+            await message.reply(text, quote=False)
+    else:
+        first = text.split("\n\n")[0]
+        if len(first) > CAPTION_LIMIT - 3:
+            first = text[: CAPTION_LIMIT - 3]
+        try:
+            await message.edit_caption(first + "…")
+        except Exception:
+            pass
+        chunks = split_text(text)  # вычисляем ОДИН раз
+        for i, chunk in enumerate(chunks, 1):
+            header = f"📝 **Часть {i}/{len(chunks)}**\n\n" if len(chunks) > 1 else ""
+            await message.reply(header + chunk, quote=False)
+            await asyncio.sleep(0.5)
+
+
+async def process_my_voice(message: Message, received: Optional[float] = None):
     logger.info(f"[MY_VOICE] обработка msg={message.id}")
+    received = received or time.monotonic()
+
+    async def show_preview(text: str):
+        await message.edit_caption(preview_caption(text))
+        record_latency("preview", time.monotonic() - received)
+
     try:
         try:
             await message.edit_caption("⏳ Транскрипция в процессе...")
         except Exception:
             pass
 
-        os.makedirs("temp", exist_ok=True)
-        file_path = await message.download(os.path.join("temp", f"{message.id}.ogg"))
-        text = await transcribe(file_path)
+        text = await voice_to_text(
+            message,
+            on_partial=lambda t: message.edit_caption(partial_text(t, CAPTION_LIMIT)),
+            on_preview=show_preview if PREVIEW_MODEL else None,
+        )
         logger.info(f"[MY_VOICE] готово: {len(text)} символов")
-
-        if len(text) <= CAPTION_LIMIT:
-            try:
-                await message.edit_caption(text)
-            except Exception as e:
-                await message.reply(text, quote=False)
-        else:
-            first = text.split("\n\n")[0]
-            if len(first) > CAPTION_LIMIT - 3:
-                first = text[: CAPTION_LIMIT - 3]
-            try:
-                await message.edit_caption(first + "…")
-            except Exception:
-                pass
-            chunks = split_text(text)  # вычисляем ОДИН раз
-            for i, chunk in enumerate(chunks, 1):
-                header = (
-                    f"📝 **Часть {i}/{len(chunks)}**\n\n" if len(chunks) > 1 else ""
-                )
-                await message.reply(header + chunk, quote=False)
-                await asyncio.sleep(0.5)
+        await send_stage.run(send_my_text, message, text)
+        record_latency("final", time.monotonic() - received)
 
     except Exception as e:
         logger.error(f"[MY_VOICE] ошибка msg={message.id}: {e}", exc_info=True)
@@ -288,72 +3079,156 @@ async def process_my_voice(message: Message):
                 await message.reply(err, quote=False)
             except Exception:
                 pass
-    finally:
-        if file_path:
-            try:
-                os.remove(file_path)
-            except OSError:
-                pass
 
 
 # ==================== Обработка чужих голосовых ====================
-async def process_tracked_voice(message: Message):
-    file_path = None
-    status_msg = None
+async def send_tracked_text(
+    message: Message, status_msg: Optional[Message], full_text: str
+):
+    """Текст в статус-сообщение, а без него (попадание в кэш) — ответом."""
+    first = full_text
+    if len(full_text) > MESSAGE_LIMIT:
+        first = full_text[: MESSAGE_LIMIT - 100] + "…"
+    if status_msg is None:
+        await message.reply(first, quote=True)
+    else:
+        await status_msg.edit_text(first)
+    if len(full_text) > MESSAGE_LIMIT:
+        chunks = split_text(full_text, MESSAGE_LIMIT)
+        for i, chunk in enumerate(chunks[1:], 2):
+            await message.reply(
+                f"📝 **Часть {i}/{len(chunks)}**\n\n{chunk}", quote=False
+            )
+            await asyncio.sleep(0.5)
+
+
+def tracked_prefix(message: Message) -> str:
+    user_name = message.from_user.first_name if message.from_user else "Пользователь"
+    if "group" in str(message.chat.type):
+        return f"**[{user_name}]** (группа):\n\n"
+    return f"**[{user_name}]:**\n\n"
+
+
+async def process_tracked_voice(message: Message, status_msg: Message):
     try:
-        user_name = (
-            message.from_user.first_name if message.from_user else "Пользователь"
-        )
-        chat_type = str(message.chat.type)
-        prefix = (
-            f"**[{user_name}]** (группа):\n\n"
-            if "group" in chat_type
-            else f"**[{user_name}]:**\n\n"
+        prefix = tracked_prefix(message)
+
+        if status_msg.text != queue_text(0):
+            try:
+                await status_msg.edit_text(queue_text(0))
+            except Exception:
+                pass
+
+        text = await voice_to_text(
+            message,
+            on_partial=lambda t: status_msg.edit_text(
+                prefix + partial_text(t, MESSAGE_LIMIT - len(prefix))
+            ),
         )
+        await send_stage.run(send_tracked_text, message, status_msg, f"{prefix}{text}")
 
+    except Exception as e:
+        logger.error(f"[TRACKED_VOICE] ошибка: {e}", exc_info=True)
+        err = f"❌ Ошибка: {str(e)[:900]}"
         try:
-            status_msg = await message.reply(
-                "⏳ Транскрипция в процессе...", quote=True
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось отправить статус: {e}")
-            return
+            await status_msg.edit_text(err)
+        except Exception:
+            pass
+
 
-        os.makedirs("temp", exist_ok=True)
-        file_path = await message.download(os.path.join("temp", f"{message.id}.ogg"))
-        text = await transcribe(file_path)
-        full_text = f"{prefix}{text}"
+# ==================== Тайминги слов ====================
+def format_timestamp(seconds: float) -> str:
+    return f"{int(seconds // 60)}:{seconds % 60:04.1f}"
 
-        if len(full_text) <= MESSAGE_LIMIT:
-            await status_msg.edit_text(full_text)
+
+async def send_word_timestamps(voice_msg: Message, status_msg: Message):
+    """Выравнивание по словам для уже распознанного голосового (по /timestamps)."""
+    voice = voice_msg.voice
+    try:
+        recent = recent_audio.get(voice.file_unique_id)
+        audio = None
+        if recent is not None:
+            audio, language = recent
         else:
-            await status_msg.edit_text(full_text[: MESSAGE_LIMIT - 100] + "…")
-            chunks = split_text(full_text, MESSAGE_LIMIT)
-            for i, chunk in enumerate(chunks[1:], 2):
-                await message.reply(
-                    f"📝 **Часть {i}/{len(chunks)}**\n\n{chunk}", quote=False
-                )
-                await asyncio.sleep(0.5)
+            speaker = (
+                voice_msg.from_user.id if voice_msg.from_user else voice_msg.chat.id
+            )
+            language = WHISPER_OPTIONS["language"] or language_profiles.language_for(
+                speaker
+            )
+        # Воркерам нужен исходный ogg, даже если PCM есть в памяти бота
+        if audio is None or job_queue is not None:
+            payload, cached = await fetch_audio(voice_msg)
+            if audio is None and job_queue is None:
+                audio = cached
+                if audio is None:
+                    audio = await decode_stage.run(load_audio, payload)
+        model_name = route_model(voice.duration)
+        if job_queue is not None:
+            segments = await transcribe_stage.run(
+                job_queue.submit,
+                "timestamps",
+                payload,
+                model=model_name,
+                language=language,
+            )
+        else:
+            segments = await transcribe_stage.run(
+                run_inference, word_timestamps_sync, audio, model_name, language
+            )
+        paragraphs = [
+            " ".join(f"`{format_timestamp(start)}` {word}" for start, word in words)
+            for words in segments
+            if words
+        ]
+        if not paragraphs:
+            await status_msg.edit_text("ℹ️ Речь не найдена")
+            return
+        chunks = split_text("\n\n".join(paragraphs))
+        await status_msg.edit_text(f"🕒 **Тайминги слов**\n\n{chunks[0]}")
+        for chunk in chunks[1:]:
+            await status_msg.reply(chunk, quote=False)
+            await asyncio.sleep(0.5)
+    except Exception as e:
+        logger.error(f"[TIMESTAMPS] ошибка: {e}", exc_info=True)
+        try:
+            await status_msg.edit_text(f"❌ Ошибка: {str(e)[:900]}")
+        except Exception:
+            pass
+
 
+# ==================== Повторное распознавание ====================
+async def retranscribe_voice(
+    voice_msg: Message, status_msg: Message, model_name: str, language
+):
+    """Голосовое заново другой моделью и/или с другим языком (по /retranscribe)."""
+    held = None
+    try:
+        if model_name not in resident_models():
+            loop = asyncio.get_running_loop()
+            await status_msg.edit_text(f"⏳ Собираю `{model_name}`...")
+            held = await loop.run_in_executor(None, adhoc_model, model_name)
+        text = await voice_to_text(
+            voice_msg,
+            on_partial=lambda t: status_msg.edit_text(partial_text(t, MESSAGE_LIMIT)),
+            model_name=model_name,
+            language=language,
+        )
+        header = f"🔁 **{model_name}, {language or 'язык по умолчанию'}**\n\n"
+        chunks = split_text(text, MESSAGE_LIMIT - len(header))
+        await status_msg.edit_text(header + chunks[0])
+        for chunk in chunks[1:]:
+            await status_msg.reply(chunk, quote=False)
+            await asyncio.sleep(0.5)
     except Exception as e:
-        logger.error(f"[TRACKED_VOICE] ошибка: {e}", exc_info=True)
-        err = f"❌ Ошибка: {str(e)[:900]}"
-        if status_msg:
-            try:
-                await status_msg.edit_text(err)
-            except Exception:
-                pass
-        else:
-            try:
-                await message.reply(err, quote=True)
-            except Exception:
-                pass
+        logger.error(f"[RETRANSCRIBE] ошибка: {e}", exc_info=True)
+        try:
+            await status_msg.edit_text(f"❌ Ошибка: {str(e)[:900]}")
+        except Exception:
+            pass
     finally:
-        if file_path:
-            try:
-                os.remove(file_path)
-            except OSError:
-                pass
+        # Разовая модель выгружается, как только её отпустят задания
+        del held
 
 
 # ==================== Хендлеры ====================
@@ -385,9 +3260,20 @@ async def my_voice(client, message: Message):
     logger.info(f"[VOICE_ME] msg={message.id} chat={message.chat.id}")
     if r.get("enabled") != "1" or r.get("my") != "1":
         return
-    task = asyncio.create_task(process_my_voice(message))
-    _background_tasks.add(task)
-    task.add_done_callback(_background_tasks.discard)
+    received = time.monotonic()
+    text = cached_text(message)
+    if text is not None:
+        try:
+            await send_stage.run(send_my_text, message, text)
+        except Exception as e:
+            logger.error(f"[MY_VOICE] ошибка msg={message.id}: {e}")
+        return
+    place = scheduler.submit(PRIORITY_MY, lambda: process_my_voice(message, received))
+    if place or not models_ready.is_set():
+        try:
+            await message.edit_caption(queue_text(place))
+        except Exception:
+            pass
 
 
 # Голосовые — ЧУЖИЕ
@@ -398,9 +3284,24 @@ async def tracked_voice(client, message: Message):
     tracked = get_tracked_users()
     if message.from_user and message.from_user.id in tracked:
         logger.info(f"[VOICE_FRIEND] msg={message.id} user={message.from_user.id}")
-        task = asyncio.create_task(process_tracked_voice(message))
-        _background_tasks.add(task)
-        task.add_done_callback(_background_tasks.discard)
+        text = cached_text(message)
+        if text is not None:
+            try:
+                await send_stage.run(
+                    send_tracked_text, message, None, tracked_prefix(message) + text
+                )
+            except Exception as e:
+                logger.error(f"[TRACKED_VOICE] ошибка: {e}")
+            return
+        place = scheduler.place_for(PRIORITY_TRACKED)
+        try:
+            status_msg = await message.reply(queue_text(place), quote=True)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить статус: {e}")
+            return
+        scheduler.submit(
+            PRIORITY_TRACKED, lambda: process_tracked_voice(message, status_msg)
+        )
 
 
 # ==================== Команды (только в Saved Messages = filters.private & filters.me) ====================
@@ -417,6 +3318,55 @@ commands = {
 }
 
 
+@app.on_message(filters.command("timestamps") & filters.me)
+async def timestamps_command(client, message: Message):
+    target = message.reply_to_message
+    if not target or not target.voice:
+        await message.reply("ℹ️ Ответь `/timestamps` на голосовое")
+        return
+    status_msg = await message.reply(
+        queue_text(scheduler.place_for(PRIORITY_BACKGROUND)), quote=True
+    )
+    scheduler.submit(
+        PRIORITY_BACKGROUND, lambda: send_word_timestamps(target, status_msg)
+    )
+
+
+@app.on_message(filters.command("retranscribe") & filters.me)
+async def retranscribe_command(client, message: Message):
+    target = message.reply_to_message
+    model_name, language = r.get("model") or MODEL_SIZE, None
+    for arg in message.command[1:]:
+        arg = arg.lower()
+        if arg in AVAILABLE_MODELS:
+            model_name = arg
+        elif re.fullmatch(r"[a-z]{2,3}|auto", arg):
+            language = arg
+        else:
+            target = None
+            break
+    if not target or not target.voice:
+        await message.reply(
+            "ℹ️ Ответь `/retranscribe [модель] [язык]` на голосовое, например "
+            "`/retranscribe large-v3 en` или `/retranscribe auto`"
+        )
+        return
+    # Модели собирают исполнители и воркеры — им доступен только набор /model
+    if (INFERENCE_PROCESSES or REMOTE) and model_name not in resident_models():
+        await message.reply(
+            f"❌ Модель `{model_name}` не загружена. Резидентные: "
+            + ", ".join(sorted(resident_models()))
+        )
+        return
+    status_msg = await message.reply(
+        queue_text(scheduler.place_for(PRIORITY_BACKGROUND)), quote=True
+    )
+    scheduler.submit(
+        PRIORITY_BACKGROUND,
+        lambda: retranscribe_voice(target, status_msg, model_name, language),
+    )
+
+
 @app.on_message(
     filters.command(["addtovoicebot", "delfromvoicebot", "listvoicebot"]) & filters.me
 )
@@ -496,6 +3446,43 @@ async def manage_tracked_users(client, message: Message):
         await message.reply(response)
 
 
+def routes_text(sep: str = "\n") -> str:
+    routes = get_routes()
+    if not routes:
+        return "все → основная модель"
+    return sep.join(f"≤ {sec} с → {name}" for sec, name in routes)
+
+
+async def route_command(message: Message, args: list):
+    if not args:
+        await message.reply(f"🔀 **Маршрутизация:**\n{routes_text()}")
+        return
+    if args[0].lower() == "off":
+        set_routes([])
+    else:
+        try:
+            max_seconds, name = int(args[0]), args[1].lower()
+        except (ValueError, IndexError):
+            await message.reply(
+                "ℹ️ **Использование:**\n"
+                "• `/model route 5 tiny` — голосовые до 5 с → tiny\n"
+                "• `/model route off` — всё в основную модель"
+            )
+            return
+        if name not in AVAILABLE_MODELS:
+            await message.reply(f"❌ Модель `{name}` не найдена")
+            return
+        routes = [[sec, m] for sec, m in get_routes() if sec != max_seconds]
+        set_routes(routes + [[max_seconds, name]])
+    status_msg = await message.reply("⏳ Обновляю резидентные модели...")
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, reload_models)
+        await status_msg.edit_text(f"✅ **Маршрутизация:**\n{routes_text()}")
+    except Exception as e:
+        await status_msg.edit_text(f"❌ Ошибка загрузки: {e}")
+
+
 @app.on_message(
     filters.command(list(commands.keys()) + ["start", "status", "help", "model"])
     & filters.private
@@ -533,9 +3520,14 @@ async def control_commands(client, message: Message):
             "`/addtovoicebot` — Добавить (в ответ на сообщение)\n"
             "`/delfromvoicebot` — Удалить\n"
             "`/listvoicebot` — Список\n\n"
+            "**Голосовые:**\n"
+            "`/timestamps` — Тайминги слов (в ответ на голосовое)\n"
+            "`/retranscribe [модель] [язык]` — Заново (в ответ на голосовое)\n\n"
             "**Модель Whisper:**\n"
             f"`/model` — Текущая\n"
-            f"`/model <имя>` — Сменить ({models_list})\n\n"
+            f"`/model <имя>` — Сменить ({models_list})\n"
+            "`/model route <сек> <имя>` — Голосовые до N с → модель\n"
+            "`/model route off` — Всё в основную модель\n\n"
             "**Инфо:**\n"
             "`/status` — Статус бота\n"
             "💡 Голосовые работают в **любых** чатах"
@@ -543,15 +3535,55 @@ async def control_commands(client, message: Message):
         return
 
     if cmd == "status":
-        await message.reply(
-            f"📊 **Статус:**\n\n"
-            f"Глобально: {'✅' if r.get('enabled') == '1' else '❌'}\n"
-            f"Свои: {'✅' if r.get('my') == '1' else '❌'}\n"
-            f"Чужие: {'✅' if r.get('friend') == '1' else '❌'}\n"
-            f"Модель: `{r.get('model') or MODEL_SIZE}`\n"
-            f"CPU: {CPU_CORES} потоков\n"
-            f"Отслеживается: {len(get_tracked_users())} польз."
-        )
+        lines = [
+            f"Глобально: {'✅' if r.get('enabled') == '1' else '❌'}",
+            f"Свои: {'✅' if r.get('my') == '1' else '❌'}",
+            f"Чужие: {'✅' if r.get('friend') == '1' else '❌'}",
+            f"Модель: `{r.get('model') or MODEL_SIZE}`"
+            + ("" if models_ready.is_set() else " (загружается)"),
+            f"Память: {lifecycle.stats()}",
+            f"Бюджет: {memory_budget.stats()}",
+            f"Короткие: {routes_text(', ')}",
+            f"CPU: {CPU_CORES} потоков",
+            f"Очередь: {scheduler.pending} ждут, "
+            f"{scheduler.active}/{scheduler.slots} в работе",
+            f"Этапы: {stages_text()}",
+            f"Задержка своих (медиана): {latency_text()}",
+            f"Качество: {governor.stats()}",
+            f"Язык: {WHISPER_LANGUAGE}"
+            + (f", {language_profiles.stats()}" if WHISPER_LANGUAGE == "auto" else ""),
+            f"Кэш: {transcript_cache.stats()}",
+        ]
+        if audio_cache is not None:
+            lines.append(f"Аудио: {audio_cache.stats()}")
+        warmup = r.hgetall("warmup")
+        if warmup:
+            lines.append(
+                "Прогрев: " + ", ".join(f"{k} {v} с" for k, v in sorted(warmup.items()))
+            )
+        if PRELOAD_CACHE_MB > 0 and not REMOTE:
+            lines.append(f"Предзагрузка: {preloader.stats()}")
+        if fingerprint_index is not None:
+            lines.append(f"Отпечатки: {fingerprint_index.stats()}")
+        if ESCALATE_MODEL:
+            stats = r.hgetall("escalate")
+            lines.append(
+                f"Эскалация: {stats.get('escalated', 0)} из "
+                f"{stats.get('segments', 0)} сегментов → {ESCALATE_MODEL}, "
+                f"{float(stats.get('seconds', 0)):.0f} с аудио"
+            )
+        if PACK_VOICES:
+            pack = r.hgetall("pack")
+            lines.append(
+                f"Упаковка: {pack.get('clips', 0)} голосовых "
+                f"в {pack.get('windows', 0)} окнах"
+            )
+        if inference_pool is not None:
+            lines.append(f"Исполнители: {inference_pool.stats()}")
+        if job_queue is not None:
+            lines.append(f"Воркеры: {job_queue.stats()}")
+        lines.append(f"Отслеживается: {len(get_tracked_users())} польз.")
+        await message.reply("📊 **Статус:**\n\n" + "\n".join(lines))
         return
 
     if cmd == "model":
@@ -561,8 +3593,12 @@ async def control_commands(client, message: Message):
                 f"{'✅' if m == current else '⚪️'} {m}" for m in AVAILABLE_MODELS
             )
             await message.reply(
-                f"🤖 **Текущая:** {current}\n\n**Доступные:**\n{models_list}\n\nСмена: `/model <имя>`"
+                f"🤖 **Текущая:** {current}\n\n**Доступные:**\n{models_list}\n\n"
+                f"**Короткие голосовые:**\n{routes_text()}\n\n"
+                "Смена: `/model <имя>`\nПравило: `/model route <сек> <имя>`"
             )
+        elif args[0].lower() == "route":
+            await route_command(message, args[1:])
         else:
             new_model = args[0].lower()
             if new_model not in AVAILABLE_MODELS:
@@ -570,10 +3606,13 @@ async def control_commands(client, message: Message):
             elif new_model == (r.get("model") or MODEL_SIZE):
                 await message.reply(f"ℹ️ Модель `{new_model}` уже загружена")
             else:
-                status_msg = await message.reply(f"⏳ Загружаю `{new_model}`...")
+                status_msg = await message.reply(
+                    f"⏳ Загружаю `{new_model}`, "
+                    f"пока работает `{r.get('model') or MODEL_SIZE}`..."
+                )
                 try:
                     loop = asyncio.get_running_loop()
-                    await loop.run_in_executor(None, load_model, new_model)
+                    await loop.run_in_executor(None, reload_models, new_model)
                     await status_msg.edit_text(
                         f"✅ Модель сменена → **{new_model}**\n\n"
                         f"**Скорость на E5620:**\n"
@@ -603,6 +3642,15 @@ def main():
     logger.info("=" * 60)
     logger.info(f"CPU: {CPU_CORES}, отслеживаемых: {len(get_tracked_users())}")
 
+    if WORKER_MODE:
+        start_models()
+        try:
+            asyncio.run(StreamWorker(TRANSCRIBE_SLOTS * BATCH_SIZE).run())
+        except KeyboardInterrupt:
+            logger.info("Воркер остановлен")
+        return
+
+    threading.Thread(target=start_models, name="models", daemon=True).start()
     try:
         app.start()
         logger.info("✅ Клиент запущен")
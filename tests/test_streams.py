@@ -0,0 +1,145 @@
+"""Очередь заданий на Redis Streams: бот ↔ воркер поверх fakeredis."""
+
+import asyncio
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+import redis  # noqa: E402
+
+SOURCE = Path(__file__).resolve().parent.parent / "src" / "userbot.py"
+
+
+class FakeRedis(fakeredis.FakeRedis):
+    """redis.Redis(host=..., port=...) поверх общего FakeServer теста."""
+
+    server = fakeredis.FakeServer()
+
+    def __init__(self, *args, host=None, port=None, **kwargs):
+        super().__init__(*args, server=self.server, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def userbot():
+    # Режим воркера: без session-файла Telegram и без JobQueue при импорте
+    mp = pytest.MonkeyPatch()
+    mp.setattr(redis, "Redis", FakeRedis)
+    mp.setattr(sys, "argv", ["userbot.py", "--worker"])
+    spec = importlib.util.spec_from_file_location("userbot", SOURCE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    mp.setattr(sys, "argv", sys.argv[:1])
+    yield module
+    mp.undo()
+
+
+@pytest.fixture
+def streams(userbot, monkeypatch):
+    FakeRedis.server = fakeredis.FakeServer()
+
+    async def transcribe(audio, model_name, options, on_partial=None):
+        return userbot.Transcript(f"{audio} {model_name} {options['language']}")
+
+    async def punctuate(result):
+        return result._replace(text=result.text.capitalize() + ".")
+
+    monkeypatch.setattr(userbot, "load_audio", bytes.decode)
+    monkeypatch.setattr(userbot, "transcribe", transcribe)
+    monkeypatch.setattr(userbot, "punctuate", punctuate)
+    return userbot
+
+
+def crash(worker):
+    """Воркер взял задание и упал, не ответив."""
+    job = worker._next()
+    assert job is not None
+    return job
+
+
+def test_round_trip(streams):
+    worker = streams.StreamWorker(1)
+    worker._ensure_group()
+    queue = streams.JobQueue()
+
+    async def scenario():
+        pending = asyncio.create_task(
+            queue.transcribe(b"hello", "small", {"language": "ru"})
+        )
+        loop = asyncio.get_running_loop()
+        job = None
+        while job is None:
+            await asyncio.sleep(0.05)
+            job = await loop.run_in_executor(None, worker._next)
+        await worker._handle(*job)
+        return await asyncio.wait_for(pending, 10)
+
+    result = asyncio.run(scenario())
+    assert result == streams.Transcript("Hello small ru.")
+    # Отвеченное задание снято с учёта группы и удалено из потока
+    assert worker.redis.xpending(streams.JOB_STREAM, streams.JOB_GROUP)["pending"] == 0
+    assert worker.redis.xlen(streams.JOB_STREAM) == 0
+
+
+def submit(streams, job_id: str):
+    streams.stream_redis().xadd(
+        streams.JOB_STREAM,
+        {
+            "id": job_id,
+            "kind": "transcribe",
+            "params": json.dumps({"model": "small", "options": {"language": "ru"}}),
+            "audio": b"hello",
+        },
+    )
+
+
+def test_abandoned_job_is_reclaimed(streams, monkeypatch):
+    dead = streams.StreamWorker(1)
+    dead.name = "dead"
+    dead._ensure_group()
+    submit(streams, "job-1")
+    entry_id, _ = crash(dead)
+
+    alive = streams.StreamWorker(1)
+    alive.name = "alive"
+    monkeypatch.setattr(streams, "JOB_TIMEOUT", 0)
+    claimed_id, fields = alive._next()
+    assert claimed_id == entry_id
+    assert fields[b"id"] == b"job-1"
+
+    asyncio.run(alive._handle(claimed_id, fields))
+    (_, reply), *_ = alive.redis.xrange(streams.RESULT_STREAM)
+    assert json.loads(reply[b"result"]) == {
+        "ok": list(streams.Transcript("Hello small ru."))
+    }
+
+
+def test_job_dropped_after_max_deliveries(streams, monkeypatch):
+    worker = streams.StreamWorker(1)
+    worker._ensure_group()
+    submit(streams, "job-2")
+    monkeypatch.setattr(streams, "JOB_TIMEOUT", 0)
+    for _ in range(streams.JOB_MAX_DELIVERIES):
+        crash(worker)
+
+    # Следующая выдача превысила бы лимит — задание отбрасывается с ошибкой
+    monkeypatch.setattr(worker.redis, "xreadgroup", lambda *args, **kwargs: [])
+    assert worker._next() is None
+    (_, reply), *_ = worker.redis.xrange(streams.RESULT_STREAM)
+    assert reply[b"id"] == b"job-2"
+    assert "error" in json.loads(reply[b"result"])
+    assert worker.redis.xpending(streams.JOB_STREAM, streams.JOB_GROUP)["pending"] == 0
+
+
+def test_no_worker_times_out(streams, monkeypatch):
+    streams.StreamWorker(1)._ensure_group()
+    queue = streams.JobQueue()
+    monkeypatch.setattr(streams, "JOB_TIMEOUT", 0.05)
+
+    with pytest.raises(RuntimeError, match="не ответили"):
+        asyncio.run(queue.transcribe(b"hello", "small", {"language": "ru"}))
+    # Задание снято с потока — поднявшийся позже воркер его не возьмёт
+    assert queue.redis.xlen(streams.JOB_STREAM) == 0